@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Copy Trac attachments out of a Trac environment, storing every distinct
+# file content once, either in a git branch or in a plain directory.
+
+import os, re, time
+import hashlib
+import shutil
+import urllib
+import subprocess as sub
+
+from fastimport import FastImport
+
+chunk_size = 1 << 20
+
+def attachment_file(env_path, type_, id_, filename):
+    """Path of an attachment in the Trac environment, or None if missing.
+    Trac 1.0 and later store attachments under hashed names in
+    files/attachments, older versions under quoted names in attachments.
+    """
+    id_ = unicode(id_).encode('utf-8')
+    name = filename.encode('utf-8')
+    id_hash = hashlib.sha1(id_).hexdigest()
+    path = os.path.join(env_path, 'files', 'attachments', type_, id_hash[:3], id_hash,
+                        hashlib.sha1(name).hexdigest() + os.path.splitext(name)[1])
+    if os.path.isfile(path):
+        return path
+    path = os.path.join(env_path, 'attachments', type_, urllib.quote(id_), urllib.quote(name))
+    if os.path.isfile(path):
+        return path
+    return None
+
+def file_sha1(path):
+    """Hex SHA-1 of the file contents, read chunk by chunk.
+    """
+    sha = hashlib.sha1()
+    fh = open(path, 'rb')
+    try:
+        while True:
+            chunk = fh.read(chunk_size)
+            if not chunk:
+                break
+            sha.update(chunk)
+    finally:
+        fh.close()
+    return sha.hexdigest()
+
+def stored_name(sha, filename):
+    """Path a file content is stored under: its hash, then the name it was
+    first attached with, cleaned up for use in git paths and URLs.
+    """
+    filename = re.sub(r'[^\w.+-]+', '_', filename, flags=re.UNICODE).strip('._') or 'file'
+    return u"%s/%s/%s" % (sha[:2], sha[2:], filename)
+
+class AttachmentStore(object):
+    """Stores each distinct file content once; files already stored by an
+    earlier run are found again by their hash.
+    """
+    def __init__(self):
+        self.paths = {}
+        self.added = 0
+
+    def known(self, names):
+        for name in names:
+            parts = name.split('/')
+            if len(parts) == 3:
+                self.paths[parts[0] + parts[1]] = name
+
+    def lookup(self, path, filename):
+        """Name the file is stored under, or would be by add, without
+        storing it.
+        """
+        sha = file_sha1(path)
+        return self.paths.get(sha) or stored_name(sha, filename)
+
+    def add(self, path, filename):
+        """Store the file unless its content is already stored; returns the
+        stored name.
+        """
+        sha = file_sha1(path)
+        name = self.paths.get(sha)
+        if name is None:
+            name = self.paths[sha] = stored_name(sha, filename)
+            self.write(path, name)
+            self.added += 1
+        return name
+
+    def close(self):
+        pass
+
+class GitAttachmentStore(AttachmentStore):
+    """Commits the files to a branch of a git repository with fast-import,
+    in a commit for every commit_every new files.
+    """
+    def __init__(self, git_path, branch, commit_every=1000):
+        AttachmentStore.__init__(self)
+        self.importer = FastImport(git_path, branch)
+        self.commit_every = commit_every
+        self.pending = []
+        if self.importer.exists:
+            p = sub.Popen(["git", "ls-tree", "-r", "--name-only", "-z", self.importer.ref],
+                          cwd=git_path, stdout=sub.PIPE)
+            self.known([name.decode('utf-8') for name in p.communicate()[0].split('\0') if name])
+
+    def write(self, path, name):
+        self.pending.append((name, self.importer.blob_file(path, chunk_size)))
+        if len(self.pending) >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        if self.pending:
+            self.importer.commit("trac", int(time.time()),
+                                 u"Add %d Trac attachments" % len(self.pending), [], self.pending)
+            self.pending = []
+
+    def close(self):
+        self.commit()
+        self.importer.close()
+
+class DirectoryAttachmentStore(AttachmentStore):
+    """Copies the files into a directory.
+    """
+    def __init__(self, path):
+        AttachmentStore.__init__(self)
+        self.path = path
+        for root, dirs, files in os.walk(path):
+            rel = os.path.relpath(root, path)
+            # A .tmp file is a copy that was interrupted
+            for name in files:
+                if name.endswith('.tmp'):
+                    os.remove(os.path.join(root, name))
+            self.known([os.path.join(rel, name).replace(os.sep, '/').decode('utf-8')
+                        for name in files if not name.endswith('.tmp')])
+
+    def write(self, path, name):
+        target = os.path.join(self.path, *name.split('/'))
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        src = open(path, 'rb')
+        dst = open(target + '.tmp', 'wb')
+        try:
+            shutil.copyfileobj(src, dst, chunk_size)
+        finally:
+            src.close()
+            dst.close()
+        os.rename(target + '.tmp', target)
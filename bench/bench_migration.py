@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# End-to-end benchmark of trac-tickets-to-gh.py against the mock GitHub API
+# using synthetic Trac databases of increasing size. Reports requests per
+# ticket, tickets/sec and the peak RSS of the migration process.
+
+import os, sys, time
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, bench_dir)
+from make_trac_db import make_trac_db
+from mock_github import MockGitHub, start_server
+
+script = os.path.join(bench_dir, '..', 'trac-tickets-to-gh.py')
+
+def run_migration(trac_db_path, api_url, extra_args):
+    """Run the migration in a child process; returns (seconds, peak rss in KB).
+    """
+    args = [sys.executable, script, '-q', '--api-url', api_url] + extra_args + [
+        trac_db_path, 'bench', 'secret', 'bench/%s' % os.path.basename(trac_db_path)]
+    devnull = open(os.devnull, 'w')
+    start = time.time()
+    p = subprocess.Popen(args, stdout=devnull, stderr=devnull)
+    pid, status, rusage = os.wait4(p.pid, 0)
+    elapsed = time.time() - start
+    devnull.close()
+    if status != 0:
+        raise RuntimeError("Migration of %s failed with status %d: %s" % (
+                trac_db_path, status, " ".join(args)))
+    return elapsed, rusage.ru_maxrss
+
+def count_tickets(trac_db_path):
+    import sqlite3
+    conn = sqlite3.connect(trac_db_path)
+    count = conn.execute('SELECT count(*) FROM ticket').fetchone()[0]
+    conn.close()
+    return count
+
+usage = """
+  %prog [options] [-- extra migration arguments]
+
+  Create synthetic Trac databases, migrate each into the mock GitHub API and
+  print the throughput. Databases are kept in the work directory between
+  runs so only the first run pays for generating them.
+"""
+parser = OptionParser(usage=usage)
+parser.add_option('-n', '--sizes', action="store", default="1000,10000,100000",
+                  help='Comma separated ticket counts (default: %default)')
+parser.add_option('-l', '--latency', action="store", default=0.02, type=float,
+                  help='Mock API latency in seconds (default: %default)')
+parser.add_option('-r', '--rate-limit', action="store", default=0, type=int,
+                  help='Mock API requests per hour, 0 for no limit (default: %default)')
+parser.add_option('-e', '--error-rate', action="store", default=0.0, type=float,
+                  help='Fraction of mock API requests failing with 502 (default: %default)')
+parser.add_option('-d', '--work-dir', action="store", default="",
+                  help='Directory for the databases (default: a temporary directory)')
+parser.add_option('-o', '--output', action="store", default="",
+                  help='Also write the results as JSON to this file')
+
+(options, args) = parser.parse_args()
+
+work_dir = options.work_dir or tempfile.mkdtemp(prefix='trac-bench-')
+if not os.path.exists(work_dir):
+    os.makedirs(work_dir)
+mock = MockGitHub(latency=options.latency, rate_limit=options.rate_limit,
+                  error_rate=options.error_rate)
+server = start_server(mock)
+
+results = []
+print "%8s %10s %10s %12s %12s %10s" % ("tickets", "seconds", "requests", "req/ticket", "tickets/sec", "peak RSS")
+for size in [int(n) for n in options.sizes.split(',')]:
+    trac_db_path = os.path.join(work_dir, 'trac-%d.db' % size)
+    if not os.path.exists(trac_db_path):
+        make_trac_db(trac_db_path, size)
+    for name in os.listdir(work_dir):
+        if name.endswith('.journal'):
+            os.remove(os.path.join(work_dir, name))
+    mock.reset()
+    tickets = count_tickets(trac_db_path)
+    elapsed, rss = run_migration(trac_db_path, server.url(), args)
+    stats = mock.stats()
+    result = {'tickets': tickets,
+              'seconds': elapsed,
+              'requests': stats['requests'],
+              'requests_per_ticket': float(stats['requests']) / tickets,
+              'tickets_per_sec': tickets / elapsed,
+              'peak_rss_kb': rss,
+              'endpoints': stats['endpoints'],
+              }
+    results.append(result)
+    print "%8d %10.1f %10d %12.2f %12.1f %8.1fMB" % (
+        tickets, elapsed, stats['requests'], result['requests_per_ticket'],
+        result['tickets_per_sec'], rss / 1024.0)
+
+if options.output:
+    fh = open(options.output, 'w')
+    json.dump(results, fh, indent=2)
+    fh.close()
+if not options.work_dir:
+    shutil.rmtree(work_dir)
+server.shutdown()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Check the Trac wiki to markdown converter against the fixture corpus and
+# compare its speed with the original line-by-line regex implementation.
+#
+# Each fixtures/NAME.wiki is converted and compared with fixtures/NAME.md.
+# Run with -u to rewrite the .md files after an intentional change.
+
+import os, sys, re, time
+import codecs
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from wikiconvert import WikiConverter
+
+fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Revisions referenced by fixtures/revisions.wiki
+rev_map = {3: 'e3b0c44', 12: 'a1b2c3d', 34: '9f86d08', 56: '2c26b46'}
+
+class LegacyWikiConverter(object):
+    """The converter as it was before the single pass rewrite, minus the
+    print of every revision found, kept as the baseline for timing.
+    """
+    regexp = (
+        ('\[(http[^ ]*) ([^\]]*)\]', '[\\2](\\1)'),        # web link
+        ('^\s\s\s\s\*', '\t\t\t*'),
+        ('^\s\s\s\*', '\t\t*'),
+        ('^\s\s\*', '\t*'),
+        ('^\s\*', '*'),                           # lists must have 2 whitespaces before the asterisk
+        ('^\s\s\s\s[0-9]\.', '    1.'),
+        ('^\s\s[0-9]\.', '  1.'),
+        ('^\s[0-9]\.', '1.'),
+        ('\'{5}([^\']*)\'{5}', '**//\\1//**'),          # bold and italic
+        ('\'{3}([^\']*)\'{3}', '**\\1**'),              # bold
+        ('\'{2}([^\']*)\'{2}', '//\\1//'),              # italic
+        ('^\s*\{{3}\s*$', '```'),                              # open code/verbatim line segment
+        ('^\s*\}{3}\s*$', '```'),                              # close code/verbatim line segment
+        ('\{{3}', '`'),                              # open code/verbatim line segment
+        ('\}{3}', '`'),                              # close code/verbatim line segment
+    )
+
+    def __init__(self, rev_map):
+        self.svn_to_git = rev_map
+
+    def convert_line(self, line):
+        for item in self.regexp:
+            line = re.sub(item[0], item[1], line)
+        match = re.search("\(In \[([0-9]+)\]\)(.+)", line)
+        if match:
+            rev = int(match.group(1))
+            git = self.svn_to_git.get(rev, "[old svn rev%d]" % rev)
+            line = "%s%s" % (git, match.group(2))
+        match = re.search("(.+)r([0-9]+)(.+)", line)
+        if match:
+            rev = int(match.group(2))
+            git = self.svn_to_git.get(rev, "[old svn rev%d]" % rev)
+            line = "%s%s%s" % (match.group(1), git, match.group(3))
+        return line
+
+    def convert(self, text):
+        lines = []
+        for line in text.splitlines():
+            lines.append(self.convert_line(line))
+        return "\n".join(lines)
+
+def load_fixtures():
+    fixtures = []
+    for filename in sorted(os.listdir(fixtures_dir)):
+        if filename.endswith('.wiki'):
+            path = os.path.join(fixtures_dir, filename)
+            # keep the line endings so \r\n handling is exercised
+            fh = codecs.open(path, 'rb', 'utf-8')
+            fixtures.append((path[:-5], fh.read()))
+            fh.close()
+    return fixtures
+
+def check(converter, fixtures, update=False):
+    failed = 0
+    for base, text in fixtures:
+        output = converter.convert(text) + "\n"
+        name = os.path.basename(base)
+        if update:
+            fh = codecs.open(base + '.md', 'wb', 'utf-8')
+            fh.write(output)
+            fh.close()
+            print "updated %s.md" % name
+            continue
+        fh = codecs.open(base + '.md', 'rb', 'utf-8')
+        expected = fh.read()
+        fh.close()
+        if output != expected:
+            failed += 1
+            print "FAIL %s" % name
+            for got, want in zip(output.splitlines(), expected.splitlines()):
+                if got != want:
+                    print "  expected: %r" % want
+                    print "  got:      %r" % got
+        else:
+            print "ok   %s" % name
+    return failed
+
+def lines_per_sec(converter, fixtures, repeat):
+    texts = [text for base, text in fixtures]
+    count = sum([len(text.splitlines()) for text in texts]) * repeat
+    start = time.time()
+    for i in range(repeat):
+        for text in texts:
+            converter.convert(text)
+    return count / (time.time() - start)
+
+usage = """
+  %prog [options]
+
+  Verify the converter output on the fixture corpus and report lines/sec for
+  the current and the legacy implementation.
+"""
+parser = OptionParser(usage=usage)
+parser.add_option('-n', '--repeat', action="store", default=2000, type=int,
+                  help='Number of times to convert the corpus when timing (default: 2000)')
+parser.add_option('-u', '--update', action="store_true", default=False,
+                  help='Rewrite the expected .md files from the current converter')
+
+(options, args) = parser.parse_args()
+
+fixtures = load_fixtures()
+failed = check(WikiConverter(rev_map), fixtures, options.update)
+if options.update:
+    sys.exit()
+
+new = lines_per_sec(WikiConverter(rev_map), fixtures, options.repeat)
+old = lines_per_sec(LegacyWikiConverter(rev_map), fixtures, options.repeat)
+print "single pass: %10.0f lines/sec" % new
+print "legacy:      %10.0f lines/sec" % old
+print "speedup:     %10.1fx" % (new / old)
+if failed:
+    sys.exit(1)
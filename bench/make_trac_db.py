@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Create a synthetic Trac sqlite database for benchmarking the migration
+# scripts. Ticket text uses the wiki constructs the converters handle, and a
+# few ids are skipped so the dummy ticket path is exercised too.
+
+import os, sys
+import random
+import sqlite3
+from optparse import OptionParser
+
+schema = """
+CREATE TABLE ticket (id integer PRIMARY KEY, type text, time integer, changetime integer,
+    component text, severity text, priority text, owner text, reporter text, cc text,
+    version text, milestone text, status text, resolution text, summary text,
+    description text, keywords text);
+CREATE INDEX ticket_time_idx ON ticket (time);
+CREATE INDEX ticket_status_idx ON ticket (status);
+CREATE TABLE ticket_change (ticket integer, time integer, author text, field text,
+    oldvalue text, newvalue text, UNIQUE (ticket,time,field));
+CREATE INDEX ticket_change_ticket_idx ON ticket_change (ticket);
+CREATE INDEX ticket_change_time_idx ON ticket_change (time);
+CREATE TABLE milestone (name text PRIMARY KEY, due integer, completed integer, description text);
+CREATE TABLE component (name text PRIMARY KEY, owner text, description text);
+CREATE TABLE wiki (name text, version integer, time integer, author text, ipnr text,
+    text text, comment text, readonly integer, UNIQUE (name,version));
+CREATE INDEX wiki_time_idx ON wiki (time);
+CREATE TABLE attachment (type text, id text, filename text, size integer, time integer,
+    description text, author text, ipnr text, UNIQUE (type,id,filename));
+"""
+
+description = """When saving a '''large''' file the program ''sometimes'' crashes.
+
+Steps to reproduce:
+ 1. open a file bigger than %(size)d MB
+ 2. press {{{Ctrl-S}}}
+ * see [http://example.com/ticket/%(id)d the log] for details
+{{{
+Traceback (most recent call last):
+  File "save.py", line %(id)d, in save
+IOError: disk full
+}}}
+Probably introduced in r%(rev)d.
+"""
+
+comment = """(In [%(rev)d]) Fixed the crash for ''%(component)s'', see r%(rev2)d.
+ * '''please''' retest"""
+
+users = ['alice', 'bob@example.com', 'carol', 'dave', 'anonymous']
+components = ['core', 'gui', 'docs', 'build', 'network', 'storage']
+milestones = ['0.%d' % i for i in range(1, 11)]
+fields = [('priority', ['minor', 'major', 'critical']),
+          ('milestone', milestones),
+          ('owner', users[:4]),
+          ('status', ['new', 'assigned', 'reopened']),
+          ]
+
+def make_trac_db(path, num_tickets, comments=3, changes=2, wiki_pages=None, gap_every=50, seed=1):
+    """Fill a new Trac database at path with num_tickets tickets having on
+    average the given number of comments and field changes.
+    """
+    rng = random.Random(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.executescript(schema)
+    start = 1200000000
+    for i, name in enumerate(milestones):
+        due = (start + i * 86400 * 30) * 1000000
+        completed = due if i < 5 else 0
+        conn.execute('INSERT INTO milestone VALUES (?, ?, ?, ?)', (name, due, completed, 'Release %s' % name))
+    for name in components:
+        conn.execute('INSERT INTO component VALUES (?, ?, ?)', (name, 'alice', ''))
+
+    for tid in range(1, num_tickets + 1):
+        if gap_every and tid % gap_every == 0:
+            # deleted tickets leave holes in the id sequence
+            continue
+        t = start + tid * 600
+        component = rng.choice(components)
+        status = rng.choice(['closed', 'closed', 'new', 'assigned'])
+        values = {'id': tid, 'size': rng.randint(1, 4096), 'rev': rng.randint(1, tid + 10),
+                  'rev2': rng.randint(1, tid + 10), 'component': component}
+        conn.execute('INSERT INTO ticket VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                     (tid, 'defect', t, t + 3600, component, 'normal', 'major',
+                      rng.choice(users[:4]), rng.choice(users), '', '',
+                      rng.choice(milestones + ['']), status,
+                      status == 'closed' and 'fixed' or '',
+                      'Crash when saving %s file #%d' % (component, tid),
+                      description % values, 'crash %s' % component))
+        ct = t
+        for c in range(rng.randint(0, comments * 2)):
+            ct += rng.randint(60, 86400)
+            values['rev'] = rng.randint(1, tid + 10)
+            values['rev2'] = rng.randint(1, tid + 10)
+            conn.execute('INSERT INTO ticket_change VALUES (?,?,?,?,?,?)',
+                         (tid, ct, rng.choice(users), 'comment', str(c + 1), comment % values))
+            if rng.randint(0, comments) < changes:
+                field, choices = rng.choice(fields)
+                conn.execute('INSERT INTO ticket_change VALUES (?,?,?,?,?,?)',
+                             (tid, ct, rng.choice(users), field, '', rng.choice(choices)))
+
+    if wiki_pages is None:
+        wiki_pages = max(num_tickets // 100, 5)
+    for p in range(wiki_pages):
+        name = p and 'SomePage%d' % p or 'WikiStart'
+        for version in range(1, rng.randint(1, 4) + 1):
+            text = "= %s =\n * see SomePage%d\n{{{\ncode\n}}}\n" % (name, rng.randint(1, wiki_pages)) * version
+            conn.execute('INSERT INTO wiki VALUES (?,?,?,?,?,?,?,?)',
+                         (name, version, start + p * 100 + version, rng.choice(users), '127.0.0.1', text, '', 0))
+    conn.commit()
+    conn.close()
+
+if __name__ == '__main__':
+    usage = """
+  %prog [options] trac_db_path num_tickets
+
+  Create a synthetic Trac database with num_tickets tickets.
+"""
+    parser = OptionParser(usage=usage)
+    parser.add_option('-c', '--comments', action="store", default=3, type=int,
+                      help='Average number of comments per ticket (default: %default)')
+    parser.add_option('-f', '--changes', action="store", default=2, type=int,
+                      help='Rough number of field changes per ticket (default: %default)')
+    parser.add_option('-g', '--gap-every', action="store", default=50, type=int,
+                      help='Skip every Nth ticket id, 0 for no gaps (default: %default)')
+    (options, args) = parser.parse_args()
+    try:
+        [trac_db_path, num_tickets] = args
+    except ValueError:
+        parser.error('Wrong number of arguments')
+    make_trac_db(trac_db_path, int(num_tickets), options.comments, options.changes,
+                 gap_every=options.gap_every)
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# A local stand-in for the parts of the GitHub v3 API used by github.py, so
+# migrations can be run and timed without creating real issues.
+#
+# Issues, comments, labels and milestones are kept in memory per repo. The
+# server can add latency, send rate limit headers and answer a fraction of
+# the requests with rate limit or server errors. GET /_stats returns the
+# request counts per endpoint and POST /_reset clears everything. GET
+# responses have an ETag and are answered with 304 Not Modified, which
+# doesn't count against the rate limit, when it matches If-None-Match.
+
+import re, sys, time
+import hashlib
+import random
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from optparse import OptionParser
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+class Repo(object):
+    def __init__(self):
+        self.issues = {}
+        self.comments = {}
+        self.labels = []
+        self.milestones = []
+        self.imports = []
+        self.last_comment_id = 0
+
+    def next_issue_number(self):
+        return len(self.issues) + 1
+
+class MockGitHub(object):
+    """State and behavior shared by all request handler threads.
+    """
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit=0, rate_window=3600,
+                 error_rate=0.0, rate_limit_error_rate=0.0, per_page=30):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.error_rate = error_rate
+        self.rate_limit_error_rate = rate_limit_error_rate
+        self.per_page = per_page
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.repos = {}
+            self.counts = {}
+            self.requests = 0
+            self.not_modified = 0
+            self.window_start = time.time()
+            self.window_used = 0
+
+    def repo(self, name):
+        if name not in self.repos:
+            self.repos[name] = Repo()
+        return self.repos[name]
+
+    def count(self, method, path):
+        key = "%s %s" % (method, re.sub(r'/repos/[^/]+/[^/]+', '/repos/:repo', re.sub(r'/[0-9]+', '/:n', path)))
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.requests += 1
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests,
+                    'not_modified': self.not_modified,
+                    'endpoints': dict(self.counts),
+                    'repos': dict([(name, {'issues': len(r.issues),
+                                           'comments': sum([len(c) for c in r.comments.values()]),
+                                           'labels': len(r.labels),
+                                           'milestones': len(r.milestones),
+                                           }) for name, r in self.repos.items()]),
+                    }
+
+    def rate_limit_headers(self):
+        """Charge one request against the window; returns (headers, exhausted).
+        """
+        if not self.rate_limit:
+            return {}, False
+        now = time.time()
+        if now - self.window_start >= self.rate_window:
+            self.window_start = now
+            self.window_used = 0
+        self.window_used += 1
+        remaining = max(self.rate_limit - self.window_used, 0)
+        headers = {'X-RateLimit-Limit': str(self.rate_limit),
+                   'X-RateLimit-Remaining': str(remaining),
+                   'X-RateLimit-Reset': str(int(self.window_start + self.rate_window)),
+                   }
+        return headers, self.window_used > self.rate_limit
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Buffer the response so headers and body go out in one packet instead
+    # of stalling on Nagle and delayed ACKs; it's flushed after each request
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, data, headers={}):
+        body = status != 304 and json.dumps(data) or ''
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.handle_api("GET")
+
+    def do_POST(self):
+        self.handle_api("POST")
+
+    def do_PATCH(self):
+        self.handle_api("PATCH")
+
+    def handle_api(self, method):
+        mock = self.server.mock
+        parts = urlparse.urlsplit(self.path)
+        path = parts.path
+        query = dict(urlparse.parse_qsl(parts.query))
+        data = None
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            data = json.loads(self.rfile.read(length))
+        if path == '/_stats':
+            return self.reply(200, mock.stats())
+        if path == '/_reset':
+            mock.reset()
+            return self.reply(200, {})
+
+        if mock.latency or mock.jitter:
+            time.sleep(mock.latency + random.uniform(0, mock.jitter))
+        with mock.lock:
+            mock.count(method, path)
+            headers, exhausted = mock.rate_limit_headers()
+            if exhausted:
+                return self.reply(403, {'message': 'API rate limit exceeded'}, headers)
+            if random.random() < mock.rate_limit_error_rate:
+                headers['Retry-After'] = '1'
+                return self.reply(403, {'message': 'You have exceeded a secondary rate limit'}, headers)
+            if random.random() < mock.error_rate:
+                return self.reply(502, {'message': 'Server Error'}, headers)
+            match = re.match(r'^/repos/([^/]+/[^/]+)/(.*)$', path)
+            if not match:
+                return self.reply(404, {'message': 'Not Found'}, headers)
+            repo = mock.repo(match.group(1))
+            status, result = self.route(repo, method, match.group(2), query, data)
+            if isinstance(result, list):
+                result, link = self.paginate(result, query)
+                if link:
+                    headers['Link'] = link
+            if method == 'GET' and status == 200:
+                headers['ETag'] = '"%s"' % hashlib.sha1(json.dumps(result) + headers.get('Link', '')).hexdigest()
+                if self.headers.get('If-None-Match') == headers['ETag']:
+                    mock.not_modified += 1
+                    if mock.rate_limit:
+                        mock.window_used -= 1
+                        headers['X-RateLimit-Remaining'] = str(int(headers['X-RateLimit-Remaining']) + 1)
+                    status = 304
+        self.reply(status, result, headers)
+
+    def paginate(self, items, query):
+        per_page = min(int(query.get('per_page', self.server.mock.per_page)), 100)
+        page = int(query.get('page', 1))
+        start = (page - 1) * per_page
+        links = []
+        last = max((len(items) + per_page - 1) // per_page, 1)
+        base = "http://%s:%d%s?" % (self.server.server_address + (urlparse.urlsplit(self.path).path,))
+        for rel, number in (('next', page + 1), ('last', last)):
+            if number <= last and page < last:
+                q = dict(query, page=str(number), per_page=str(per_page))
+                links.append('<%s%s>; rel="%s"' % (base, '&'.join(['%s=%s' % kv for kv in sorted(q.items())]), rel))
+        return items[start:start + per_page], ', '.join(links)
+
+    def route(self, repo, method, path, query, data):
+        if path == 'issues':
+            if method == 'GET':
+                state = query.get('state', 'open')
+                issues = [i for i in repo.issues.values() if state == 'all' or i['state'] == state]
+                issues.sort(key=lambda i: i['number'], reverse=query.get('direction', 'desc') == 'desc')
+                return 200, issues
+            number = repo.next_issue_number()
+            issue = {'number': number,
+                     'title': data['title'],
+                     'body': data.get('body'),
+                     'labels': [{'name': name} for name in data.get('labels', [])],
+                     'milestone': data.get('milestone') and {'number': data['milestone']},
+                     # GitHub ignores the state when creating an issue
+                     'state': 'open',
+                     'comments': 0,
+                     }
+            repo.issues[number] = issue
+            repo.comments[number] = []
+            return 201, issue
+        if path == 'issues/comments':
+            comments = [c for number in sorted(repo.comments) for c in repo.comments[number]]
+            comments.sort(key=lambda c: c['id'], reverse=query.get('direction', 'asc') == 'desc')
+            return 200, comments
+        match = re.match(r'^issues/([0-9]+)(/comments)?$', path)
+        if match:
+            number = int(match.group(1))
+            if number not in repo.issues:
+                return 404, {'message': 'Not Found'}
+            issue = repo.issues[number]
+            if match.group(2):
+                if method == 'GET':
+                    return 200, repo.comments[number]
+                repo.last_comment_id += 1
+                comment = {'id': repo.last_comment_id, 'body': data['body'],
+                           'issue_url': 'issues/%d' % number}
+                repo.comments[number].append(comment)
+                issue['comments'] += 1
+                return 201, comment
+            if method != 'GET':
+                for key, value in data.items():
+                    if key == 'labels':
+                        value = [{'name': name} for name in value]
+                    elif key == 'milestone':
+                        value = value and {'number': value}
+                    issue[key] = value
+            return 200, issue
+        if path == 'labels':
+            if method == 'GET':
+                return 200, repo.labels
+            label = {'name': data['name'], 'url': 'labels/%s' % data['name'], 'color': 'ededed'}
+            repo.labels.append(label)
+            return 201, label
+        if path == 'milestones':
+            if method == 'GET':
+                state = query.get('state', 'open')
+                return 200, [m for m in repo.milestones if state == 'all' or m['state'] == state]
+            milestone = dict(data)
+            milestone['number'] = len(repo.milestones) + 1
+            milestone.setdefault('state', 'open')
+            repo.milestones.append(milestone)
+            return 201, milestone
+        if path == 'import/issues':
+            if method == 'GET':
+                since = query.get('since', '')
+                return 200, [i for i in repo.imports if i['created_at'] >= since]
+            # Imports are processed right away, but like GitHub the
+            # response only says they are pending
+            issue = data['issue']
+            number = repo.next_issue_number()
+            for name in issue.get('labels', []):
+                if name not in [label['name'] for label in repo.labels]:
+                    repo.labels.append({'name': name, 'url': 'labels/%s' % name, 'color': 'ededed'})
+            repo.issues[number] = {'number': number,
+                                   'title': issue['title'],
+                                   'body': issue.get('body'),
+                                   'labels': [{'name': name} for name in issue.get('labels', [])],
+                                   'milestone': issue.get('milestone') and {'number': issue['milestone']},
+                                   'state': issue.get('closed') and 'closed' or 'open',
+                                   'created_at': issue.get('created_at'),
+                                   'comments': len(data.get('comments', [])),
+                                   }
+            repo.comments[number] = []
+            for comment in data.get('comments', []):
+                repo.last_comment_id += 1
+                repo.comments[number].append({'id': repo.last_comment_id, 'body': comment['body'],
+                                              'issue_url': 'issues/%d' % number,
+                                              'created_at': comment.get('created_at')})
+            import_id = len(repo.imports) + 1
+            status = {'id': import_id,
+                      'status': 'imported',
+                      'url': 'import/issues/%d' % import_id,
+                      'issue_url': 'issues/%d' % number,
+                      'created_at': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                      }
+            repo.imports.append(status)
+            return 202, dict(status, status='pending', issue_url=None)
+        match = re.match(r'^import/issues/([0-9]+)$', path)
+        if match:
+            number = int(match.group(1))
+            if number > len(repo.imports):
+                return 404, {'message': 'Not Found'}
+            return 200, repo.imports[number - 1]
+        return 404, {'message': 'Not Found'}
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, mock):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.mock = mock
+
+    def url(self):
+        return "http://%s:%d" % self.server_address
+
+def start_server(mock, host='127.0.0.1', port=0):
+    """Serve mock from a background thread; returns the server.
+    """
+    server = MockServer((host, port), mock)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+if __name__ == '__main__':
+    usage = """
+  %prog [options]
+
+  Run a mock GitHub API server, then point the migration at it with
+  --api-url http://127.0.0.1:PORT
+"""
+    parser = OptionParser(usage=usage)
+    parser.add_option('-p', '--port', action="store", default=8000, type=int,
+                      help='Port to listen on (default: %default)')
+    parser.add_option('-l', '--latency', action="store", default=0.0, type=float,
+                      help='Seconds added to every response (default: %default)')
+    parser.add_option('-j', '--jitter', action="store", default=0.0, type=float,
+                      help='Random extra seconds added to every response (default: %default)')
+    parser.add_option('-r', '--rate-limit', action="store", default=0, type=int,
+                      help='Requests allowed per rate window, 0 for no limit (default: %default)')
+    parser.add_option('-w', '--rate-window', action="store", default=3600, type=int,
+                      help='Length of the rate window in seconds (default: %default)')
+    parser.add_option('-e', '--error-rate', action="store", default=0.0, type=float,
+                      help='Fraction of requests answered with 502 (default: %default)')
+    parser.add_option('-s', '--secondary-rate', action="store", default=0.0, type=float,
+                      help='Fraction of requests answered with a secondary rate limit (default: %default)')
+    (options, args) = parser.parse_args()
+
+    mock = MockGitHub(options.latency, options.jitter, options.rate_limit,
+                      options.rate_window, options.error_rate, options.secondary_rate)
+    server = MockServer(('127.0.0.1', options.port), mock)
+    print "Mock GitHub API listening on %s" % server.url()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Write commits into a git repository with git fast-import, without a
+# working tree or one git process per commit.
+
+import os
+import re
+import subprocess as sub
+
+class FastImport(object):
+    """Streams commits into a git repository through git fast-import,
+    continuing from the current tip of the branch if it exists.
+    """
+    def __init__(self, git_path, branch):
+        self.ref = "refs/heads/%s" % branch
+        p = sub.Popen(["git", "rev-parse", "--verify", "-q", self.ref], cwd=git_path,
+                      stdout=sub.PIPE, stderr=sub.PIPE)
+        p.communicate()
+        self.exists = p.returncode == 0
+        self.parent = self.exists and self.ref + "^0" or None
+        self.proc = sub.Popen(["git", "fast-import", "--quiet", "--date-format=raw"],
+                              cwd=git_path, stdin=sub.PIPE)
+        self.out = self.proc.stdin
+        self.count = 0
+        self.last_mark = 0
+
+    def ident(self, author):
+        """Return the utf-8 git ident of a Trac author, which is a user
+        name, an email address or 'Name <email>'. Angle brackets and line
+        breaks would end the ident early, so they are dropped.
+        """
+        name, email = author, ""
+        match = re.match(r"^(.*)<([^<>]*)>\s*$", author, re.S)
+        if match:
+            name, email = match.groups()
+        elif "@" in author:
+            name, email = author.split("@")[0], author
+        name, email = [re.sub(r"[<>\r\n]", "", part).strip() for part in (name, email)]
+        return ("%s <%s>" % (name, email)).strip().encode("utf-8")
+
+    def data(self, data):
+        self.out.write("data %d\n%s\n" % (len(data), data))
+
+    def blob_file(self, path, chunk_size=1 << 20):
+        """Copy the file into the repository chunk by chunk, so it's never
+        held in memory; returns the mark to commit it with.
+        """
+        self.last_mark += 1
+        fh = open(path, "rb")
+        try:
+            self.out.write("blob\nmark :%d\ndata %d\n" % (self.last_mark, os.fstat(fh.fileno()).st_size))
+            while True:
+                chunk = fh.read(chunk_size)
+                if not chunk:
+                    break
+                self.out.write(chunk)
+        finally:
+            fh.close()
+        self.out.write("\n")
+        return self.last_mark
+
+    def commit(self, author, time_t, message, files, marks=()):
+        """Commit the (filename, utf-8 data) files and the (filename, mark)
+        blobs written by blob_file as author at time_t.
+        """
+        ident = self.ident(author)
+        self.out.write("commit %s\n" % self.ref)
+        self.out.write("author %s %d +0000\n" % (ident, time_t))
+        self.out.write("committer %s %d +0000\n" % (ident, time_t))
+        self.data(message.encode("utf-8"))
+        if self.parent:
+            self.out.write("from %s\n" % self.parent)
+            self.parent = None
+        for filename, data in files:
+            self.out.write("M 100644 inline %s\n" % filename.encode("utf-8"))
+            self.data(data)
+        for filename, mark in marks:
+            self.out.write("M 100644 :%d %s\n" % (mark, filename.encode("utf-8")))
+        self.out.write("\n")
+        self.count += 1
+
+    def close(self):
+        self.out.close()
+        if self.proc.wait() != 0:
+            raise RuntimeError("git fast-import failed with status %d" % self.proc.returncode)
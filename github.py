@@ -1,41 +1,417 @@
 import base64
-import urllib2
+import errno
+import httplib
+import socket
+import random
+import threading
+import time
+import urllib
+import urlparse
+import Queue
+from multiprocessing.pool import ThreadPool
+import logging
 try:
     import json
 except ImportError:
     import simplejson as json
 
+class ConnectionPool(object):
+    """Bounded pool of keep-alive HTTP(S) connections to a single host.
+
+    Connections are handed out last-in first-out so the most recently used
+    (and therefore least likely to have been dropped by the server) socket
+    is reused first. The pool never holds more than maxsize connections;
+    callers block in get() until one is returned.
+    """
+    def __init__(self, scheme, host, port=None, maxsize=4, timeout=60):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.queue = Queue.LifoQueue(maxsize)
+        # None is a placeholder for a connection that hasn't been opened yet
+        for i in range(maxsize):
+            self.queue.put(None)
+
+    def new_connection(self):
+        if self.scheme == 'https':
+            cls = httplib.HTTPSConnection
+        else:
+            cls = httplib.HTTPConnection
+        return cls(self.host, self.port, timeout=self.timeout)
+
+    def get(self):
+        conn = self.queue.get()
+        if conn is None:
+            conn = self.new_connection()
+        return conn
+
+    def put(self, conn):
+        self.queue.put(conn)
+
+    def request(self, method, path, body=None, headers={}):
+        """Send the request on a pooled connection, return (status, headers, data).
+        A connection the server has silently closed is detected on reuse and
+        the request is retried once on a fresh socket, but only if the
+        failure shows the server never got it (see stale). Anything else,
+        timeouts included, is raised: a POST may already have been applied.
+        """
+        conn = self.get()
+        try:
+            for attempt in (0, 1):
+                reused = conn.sock is not None
+                sending = True
+                try:
+                    conn.request(method, path, body, headers)
+                    sending = False
+                    res = conn.getresponse()
+                    data = res.read()
+                except (httplib.HTTPException, socket.error), e:
+                    conn.close()
+                    if reused and attempt == 0 and self.stale(e, sending or method in ('GET', 'HEAD')):
+                        conn = self.new_connection()
+                        continue
+                    raise
+                if res.will_close:
+                    conn.close()
+                return res.status, dict(res.getheaders()), data
+        finally:
+            self.put(conn)
+
+    def stale(self, error, unsent):
+        """Whether the error is a kept-alive connection the server had
+        already closed: it was closed without a single byte of response, or
+        reset while the request was unsent. GET and HEAD count as unsent
+        throughout, as sending them again does no harm.
+        """
+        if isinstance(error, socket.timeout):
+            return False
+        if isinstance(error, httplib.BadStatusLine):
+            return error.line in ("''", '') or error.line.startswith("No status line received")
+        if isinstance(error, socket.error):
+            return unsent and error.errno in (errno.ECONNRESET, errno.EPIPE)
+        return False
+
+    def close(self):
+        """Close every idle connection in the pool.
+        """
+        conns = []
+        while True:
+            try:
+                conns.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        for conn in conns:
+            if conn is not None:
+                conn.close()
+            self.queue.put(None)
+
+class RateLimiter(object):
+    """Paces requests to stay within GitHub's rate limits and decides how
+    long to back off after a failed request.
+
+    One limiter is shared by every thread using a client. It tracks the
+    budget from the X-RateLimit-* headers, spreads the remaining requests
+    over the rest of the window once the budget runs low, and pauses all
+    threads when GitHub answers with a primary or secondary rate limit.
+    Each secondary limit also doubles a minimum spacing between requests,
+    which then decays again while requests succeed.
+    """
+    def __init__(self, max_retries=8, backoff_base=1.0, backoff_max=300.0,
+                 pace_below=200):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pace_below = pace_below
+        self.lock = threading.Lock()
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.interval = 0.0
+        self.next_slot = 0.0
+        self.resume_at = 0.0
+        self.retries = 0
+
+    def budget(self):
+        """Return the last known rate limit state as a dictionary.
+        """
+        with self.lock:
+            return {'limit': self.limit,
+                    'remaining': self.remaining,
+                    'reset': self.reset,
+                    'interval': self.interval,
+                    'retries': self.retries,
+                    }
+
+    def acquire(self):
+        """Block until the next request may be sent.
+        """
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_slot, self.resume_at)
+            spacing = self.interval
+            if self.remaining is not None and self.reset is not None:
+                window = self.reset - now
+                if self.remaining <= 0 and window > 0:
+                    start = max(start, self.reset + 1)
+                elif window > 0 and self.remaining < self.pace_below:
+                    spacing = max(spacing, window / self.remaining)
+                if self.remaining > 0:
+                    # reserve our share until the response tells us the real count
+                    self.remaining -= 1
+            self.next_slot = start + spacing
+        if start > now:
+            time.sleep(start - now)
+
+    def update(self, status, headers):
+        """Record the budget from the response headers.
+        """
+        with self.lock:
+            try:
+                self.limit = int(headers['x-ratelimit-limit'])
+                self.remaining = int(headers['x-ratelimit-remaining'])
+                self.reset = int(headers['x-ratelimit-reset'])
+            except (KeyError, ValueError):
+                pass
+            if status < 400:
+                self.interval *= 0.9
+                if self.interval < 0.01:
+                    self.interval = 0.0
+
+    def is_rate_limited(self, status, headers, body):
+        if status == 429:
+            return True
+        if status != 403:
+            return False
+        return (headers.get('x-ratelimit-remaining') == '0' or
+                'retry-after' in headers or
+                'rate limit' in (body or '').lower())
+
+    def retry_delay(self, attempt, status=None, headers={}, body=None, idempotent=True):
+        """Return the seconds to wait before retrying, or None to give up.
+        A status of None means the request failed at the network level.
+        Rate limited requests are always retried since GitHub did not act
+        on them; other failures only for idempotent requests, as a POST that
+        timed out may still have created the issue or comment.
+        """
+        if attempt >= self.max_retries:
+            return None
+        rate_limited = status is not None and self.is_rate_limited(status, headers, body)
+        if not rate_limited:
+            if not idempotent:
+                return None
+            if status is not None and status < 500:
+                return None
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        delay *= random.uniform(0.5, 1.5)
+        if rate_limited:
+            if 'retry-after' in headers:
+                try:
+                    delay = max(delay, float(headers['retry-after']))
+                except ValueError:
+                    pass
+            elif headers.get('x-ratelimit-remaining') == '0':
+                try:
+                    delay = max(delay, int(headers['x-ratelimit-reset']) - time.time() + 1)
+                except (KeyError, ValueError):
+                    pass
+        with self.lock:
+            self.retries += 1
+            if rate_limited:
+                now = time.time()
+                # A secondary limit says to slow down; the primary one only
+                # that the budget is used up until the reset. Responses to
+                # requests sent before the pause are the same event.
+                secondary = 'retry-after' in headers or headers.get('x-ratelimit-remaining') != '0'
+                if secondary and now >= self.resume_at:
+                    self.interval = min(max(self.interval * 2, 0.25), 10.0)
+                self.resume_at = max(self.resume_at, now + delay)
+        return delay
+
+def parse_link_header(value):
+    """Return {rel: url} from a Link header like '<url>; rel="next", ...'.
+    """
+    links = {}
+    for part in (value or '').split(','):
+        pieces = part.split(';')
+        url = pieces[0].strip()
+        if not url.startswith('<') or not url.endswith('>'):
+            continue
+        for param in pieces[1:]:
+            key, _, rel = param.strip().partition('=')
+            if key == 'rel':
+                links[rel.strip('"')] = url[1:-1]
+    return links
+
 class GitHub(object):
     """Connections, queries and posts to GitHub.
     """
-    def __init__(self, username, password, repo):
+    api_url = "https://api.github.com"
+
+    def __init__(self, username, password, repo, pool_size=4, limiter=None, api_url=None,
+                 metrics=None, cache=None, pool=None):
         """Username and password for auth; repo is like 'myorg/myapp'.
+        The pool_size is the maximum number of keep-alive connections.
+        The api_url can point to GitHub Enterprise or a test server.
+        If metrics is given, see metrics.Metrics, every attempt and retry
+        is recorded there. With a cache, see httpcache.ResponseCache, GETs
+        of responses cached before are conditional requests. Clients of
+        the same host can share a pool, which then replaces pool_size, as
+        well as a limiter and a cache.
         """
         self.username = username
         self.password = password
         self.repo = repo
-        self.url = "https://api.github.com/repos/%s" % self.repo
-        self.auth = base64.encodestring('%s:%s' % (self.username, self.password))[:-1]
+        if api_url:
+            self.api_url = api_url.rstrip('/')
+        self.url = "%s/repos/%s" % (self.api_url, self.repo)
+        self.auth = base64.b64encode('%s:%s' % (self.username, self.password))
+        # Headers are built once and copied per request
+        self.headers = {"Authorization": "Basic %s" % self.auth,
+                        "Accept": "application/json",
+                        "Connection": "keep-alive",
+                        }
+        parts = urlparse.urlsplit(self.url)
+        self.path_prefix = parts.path
+        self.own_pool = pool is None
+        if pool is None:
+            pool = ConnectionPool(parts.scheme, parts.hostname, parts.port,
+                                  maxsize=pool_size)
+        self.pool = pool
+        if limiter is None:
+            limiter = RateLimiter()
+        self.limiter = limiter
+        self.metrics = metrics
+        self.cache = cache
 
-    def access(self, path, query=None, data=None):
+    def access(self, path, query=None, data=None, headers=None):
         """Append the API path to the URL GET, or POST if there's data.
+        Extra request headers, like a preview Accept type, can be given.
         """
-        if not path.startswith('/'):
-            path = '/' + path
-        if query:
-            path += '?' + query
-        url = self.url + path
-        req = urllib2.Request(url)
-        req.add_header("Authorization", "Basic %s" % self.auth)
-        try:
-            if data:
-                    req.add_header("Content-Type", "application/json")
-                    res = urllib2.urlopen(req, json.dumps(data))
+        return self.request(path, query, data, headers)[0]
+
+    def request(self, path, query=None, data=None, headers=None):
+        """Like access, but returns (decoded json, response headers).
+        The path may also be a full URL, as found in Link headers.
+        """
+        if path.startswith('http'):
+            url = path
+            parts = urlparse.urlsplit(url)
+            path = parts.path
+            if parts.query:
+                path += '?' + parts.query
+        else:
+            if not path.startswith('/'):
+                path = '/' + path
+            if query:
+                path += '?' + query
+            url = self.url + path
+            path = self.path_prefix + path
+        headers = dict(self.headers, **(headers or {}))
+        if data:
+            method = "POST"
+            body = json.dumps(data)
+            headers["Content-Type"] = "application/json"
+        else:
+            method = "GET"
+            body = None
+        cached = None
+        if method == "GET" and self.cache is not None:
+            cached = self.cache.get(url)
+            if cached is not None:
+                headers.update(self.cache.validators(cached[0]))
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            start = time.time()
+            try:
+                status, res_headers, res_data = self.pool.request(
+                    method, path, body, headers)
+            except (IOError, httplib.HTTPException), e:
+                if self.metrics:
+                    self.metrics.record_request(method, path, time.time() - start, None)
+                delay = self.limiter.retry_delay(attempt, idempotent=(method == "GET"))
+                if delay is None:
+                    raise RuntimeError("Error on url=%s e=%s" % (url, e))
+                logging.warning("Retrying url=%s in %.1fs e=%s" % (url, delay, e))
+            else:
+                if self.metrics:
+                    self.metrics.record_request(method, path, time.time() - start, status)
+                self.limiter.update(status, res_headers)
+                if status < 400:
+                    break
+                delay = self.limiter.retry_delay(attempt, status, res_headers, res_data,
+                                                 idempotent=(method == "GET"))
+                if delay is None:
+                    raise RuntimeError("Error on url=%s e=HTTP Error %d: %s" % (
+                            url, status, res_data))
+                logging.warning("Retrying url=%s in %.1fs status=%d" % (url, delay, status))
+            if self.metrics:
+                self.metrics.record_retry(method, path)
+            time.sleep(delay)
+            attempt += 1
+        if self.cache is not None:
+            if status == 304 and cached is not None:
+                self.cache.touch(url)
+                res_headers = dict(cached[0], **res_headers)
+                res_data = cached[1]
+                if self.metrics:
+                    self.metrics.count('cache_hits')
+            elif method == "GET":
+                self.cache.put(url, res_headers, res_data)
             else:
-                    res =  urllib2.urlopen(req)
-            return json.load(res)
-        except (IOError, urllib2.HTTPError), e:
-            raise RuntimeError("Error on url=%s e=%s" % (url, e))
+                self.invalidate(url)
+        return json.loads(res_data), res_headers
+
+    def invalidate(self, url):
+        """Drop the cached responses a POST to url may have changed, which
+        is its whole collection: a new comment also changes its issue and
+        every issue and comment list. Imports create issues too. GitHub
+        links the later pages of lists by repository id rather than name.
+        """
+        path = url[len(self.url):].split('?')[0].strip('/')
+        collections = [path.split('/')[0]]
+        if collections[0] == 'import':
+            collections.append('issues')
+        for collection in collections:
+            for base in (self.url, "%s/repositories/*" % self.api_url):
+                self.cache.invalidate("%s/%s*" % (base, collection))
+
+    def iter_all(self, path, query=None, concurrent=0, headers=None):
+        """Yield every item of a list endpoint, 100 per request.
+        Pages are followed through the Link rel="next" header. If concurrent
+        is more than 1 and the first page links to the last one, the
+        remaining pages are fetched on that many threads but still yielded
+        in order.
+        """
+        params = urlparse.parse_qsl(query or '')
+        params = [(k, v) for k, v in params if k != 'per_page'] + [('per_page', '100')]
+        request = lambda url, query=None: self.request(url, query, headers=headers)
+        items, res_headers = request(path, urllib.urlencode(params))
+        for item in items:
+            yield item
+        links = parse_link_header(res_headers.get('link'))
+        if concurrent > 1 and 'last' in links:
+            parts = urlparse.urlsplit(links['last'])
+            last_params = urlparse.parse_qsl(parts.query)
+            last = int(dict(last_params)['page'])
+            def page_url(page):
+                page_params = [(k, v) for k, v in last_params if k != 'page'] + [('page', str(page))]
+                return urlparse.urlunsplit(parts[:3] + (urllib.urlencode(page_params), ''))
+            pool = ThreadPool(min(concurrent, max(last - 1, 1)))
+            try:
+                for items, res_headers in pool.imap(request, [page_url(page) for page in range(2, last + 1)]):
+                    for item in items:
+                        yield item
+            finally:
+                pool.terminate()
+            return
+        while 'next' in links:
+            items, res_headers = request(links['next'])
+            for item in items:
+                yield item
+            links = parse_link_header(res_headers.get('link'))
 
     def issues(self, id_=None, query=None, data=None):
         """Get issues or POST and issue with data.
@@ -48,6 +424,19 @@ class GitHub(object):
             path += '/' + str(id_)
         return self.access(path, query=query, data=data)
 
+    def iter_issues(self, query=None, concurrent=0):
+        """Yield all issues matching the query, see iter_all.
+        """
+        return self.iter_all('issues', query, concurrent)
+
+    def highest_issue_number(self):
+        """Number of the most recently created issue or pull request, 0 if none.
+        """
+        latest = self.issues(query='state=all&sort=created&direction=desc&per_page=1')
+        if latest:
+            return latest[0]['number']
+        return 0
+
     def issue_comments(self, id_, query=None, data=None):
         """Get comments for a ticket by its number or POST a comment with data.
         Example: issue_comments(5, data={'body': 'Is decapitated'})
@@ -56,12 +445,28 @@ class GitHub(object):
         #TODO: this is BROKEN
         return self.access('issues/%d/comments' % id_, query=query, data=data)
 
+    def iter_issue_comments(self, id_, query=None, concurrent=0):
+        """Yield all comments of an issue, see iter_all.
+        """
+        return self.iter_all('issues/%d/comments' % id_, query, concurrent)
+
+    def iter_repo_comments(self, query=None, concurrent=0):
+        """Yield the comments of all issues in the repository, see iter_all.
+        Each comment links to its issue through 'issue_url'.
+        """
+        return self.iter_all('issues/comments', query, concurrent)
+
     def labels(self, query=None, data=None):
         """Get labels or POST a label with data.
         Post like: labels(data={'name': 'NewLabel'})
         """
         return self.access('labels', query=query, data=data)
 
+    def iter_labels(self, query=None, concurrent=0):
+        """Yield all labels, see iter_all.
+        """
+        return self.iter_all('labels', query, concurrent)
+
     def milestones(self, query=None, data=None):
         """Get milestones or POST if data.
         Post like: milestones(data={'title':'NEWMILESTONE'})
@@ -69,3 +474,340 @@ class GitHub(object):
         """
         return self.access('milestones', query=query, data=data)
 
+    def iter_milestones(self, query=None, concurrent=0):
+        """Yield all milestones; pass query='state=all' to include closed ones.
+        """
+        return self.iter_all('milestones', query, concurrent)
+
+    # The issue import API is a preview and has to be asked for explicitly
+    import_headers = {"Accept": "application/vnd.github.golden-comet-preview+json"}
+
+    def import_issue(self, issue, comments=None):
+        """Queue an issue with its comments for import; returns the import
+        status, whose 'id' is used to follow it. Unlike issues(), the issue
+        can have 'created_at', 'closed' and label names that don't exist yet:
+        import_issue({'title': 'Plough', 'body': 'Plover', 'closed': True},
+                     [{'body': 'Done', 'created_at': '2009-01-02T03:04:05Z'}])
+        """
+        data = {'issue': issue}
+        if comments:
+            data['comments'] = comments
+        return self.access('import/issues', data=data, headers=self.import_headers)
+
+    def import_status(self, id_):
+        return self.access('import/issues/%d' % id_, headers=self.import_headers)
+
+    def iter_import_statuses(self, since, concurrent=0):
+        """Yield the status of every import created since the given ISO time.
+        """
+        return self.iter_all('import/issues', urllib.urlencode([('since', since)]),
+                             concurrent, headers=self.import_headers)
+
+    def rate_limit(self):
+        """Current request budget, see RateLimiter.budget.
+        """
+        return self.limiter.budget()
+
+    def close(self):
+        if self.own_pool:
+            self.pool.close()
+
+class IssueImporter(object):
+    """Creates issues through the issue import API, which takes an issue
+    with all its comments in one request and processes it in the background.
+
+    Imports are submitted in order from the calling thread, since GitHub
+    numbers them in the order they were queued. A poller thread checks all
+    pending imports at once through the status list every poll_interval
+    seconds and calls on_done(key, number) or on_error(key, errors) for each
+    one that finished. The list only goes back to the oldest import still
+    pending, so a poll costs about the same however many imports the run
+    has made. At most max_pending imports are in flight.
+    """
+    def __init__(self, github, on_done, on_error, poll_interval=1.0, max_pending=100):
+        self.github = github
+        self.on_done = on_done
+        self.on_error = on_error
+        self.poll_interval = poll_interval
+        self.max_pending = max_pending
+        # import id -> (key, created_at)
+        self.pending = {}
+        self.closing = False
+        self.error = None
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, key, issue, comments=None):
+        """Queue the import of an issue; key is passed back to the callbacks.
+        """
+        with self.cond:
+            while len(self.pending) >= self.max_pending and self.error is None:
+                self.cond.wait()
+            if self.error is not None:
+                raise RuntimeError("Polling issue imports failed e=%s" % self.error)
+        status = self.github.import_issue(issue, comments)
+        with self.cond:
+            self.pending[status['id']] = (key, status['created_at'])
+            self.cond.notify_all()
+        return status['id']
+
+    def run(self):
+        try:
+            while True:
+                with self.cond:
+                    while not self.pending and not self.closing:
+                        self.cond.wait()
+                    if not self.pending:
+                        return
+                time.sleep(self.poll_interval)
+                with self.cond:
+                    since = min([created for key, created in self.pending.values()])
+                self.poll(since)
+        except Exception, e:
+            logging.exception("Polling issue imports failed")
+            with self.cond:
+                self.error = e
+                self.cond.notify_all()
+
+    def poll(self, since):
+        for status in self.github.iter_import_statuses(since):
+            with self.cond:
+                key = self.pending.get(status['id'], (None,))[0]
+            if key is None or status['status'] == 'pending':
+                continue
+            if status['status'] == 'imported':
+                if not status.get('issue_url'):
+                    # the list may not link the issue yet
+                    status = self.github.import_status(status['id'])
+                number = int(status['issue_url'].rstrip('/').rsplit('/', 1)[1])
+                self.on_done(key, number)
+            else:
+                self.on_error(key, status.get('errors') or status['status'])
+            with self.cond:
+                del self.pending[status['id']]
+                self.cond.notify_all()
+
+    def close(self):
+        """Wait until every submitted import has finished.
+        """
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        self.thread.join()
+        if self.error is not None:
+            raise RuntimeError("Polling issue imports failed e=%s" % self.error)
+
+class CancelledError(RuntimeError):
+    pass
+
+class Future(object):
+    """Result of a request queued on AsyncGitHub.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.state = 'pending'
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def set_running(self):
+        """Returns False if the future was cancelled before it could start.
+        """
+        with self.cond:
+            if self.state != 'pending':
+                return False
+            self.state = 'running'
+            return True
+
+    def finish(self, state, value=None, error=None):
+        with self.cond:
+            if self.state in ('done', 'cancelled'):
+                return False
+            callbacks = self.settle(state, value, error)
+        for callback in callbacks:
+            callback(self)
+        return True
+
+    def settle(self, state, value, error):
+        # Called holding the condition; returns the callbacks to run
+        # once it's released
+        self.state = state
+        self.value = value
+        self.error = error
+        self.cond.notify_all()
+        callbacks, self.callbacks = self.callbacks, []
+        return callbacks
+
+    def set_result(self, value):
+        self.finish('done', value)
+
+    def set_exception(self, error):
+        self.finish('done', error=error)
+
+    def cancel(self, reason="cancelled"):
+        """Cancel the request if it hasn't started; returns True if it was.
+        """
+        with self.cond:
+            # checked and changed at once, so set_running can't slip in
+            if self.state != 'pending':
+                return False
+            callbacks = self.settle('cancelled', None, CancelledError(reason))
+        for callback in callbacks:
+            callback(self)
+        return True
+
+    def cancelled(self):
+        return self.state == 'cancelled'
+
+    def done(self):
+        return self.state in ('done', 'cancelled')
+
+    def add_done_callback(self, callback):
+        """Call callback(future) once done, from the thread that finished it.
+        Callbacks run on the client's threads and must not queue requests.
+        """
+        with self.cond:
+            if not self.done():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def result(self, timeout=None):
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.cond:
+            # Short waits, as a plain wait can't be interrupted with Ctrl-C
+            while not self.done():
+                if timeout is not None and time.time() >= deadline:
+                    raise RuntimeError("Timed out waiting for the request")
+                self.cond.wait(1.0)
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class AsyncGitHub(object):
+    """Non-blocking counterpart of GitHub: the same methods return a Future
+    right away and the request runs on one of max_in_flight threads sharing
+    the client's connection pool and rate limiter.
+
+    Requests for the same issue (comments, updates, closing) run one at a
+    time in the order they were queued; if one fails the ones queued after
+    it are cancelled, so comments are never posted out of order. Only the
+    first request of every issue is handed to the threads, so requests
+    waiting behind another one for the same issue don't take up a slot.
+    Queuing blocks once max_in_flight requests are handed out, or once
+    max_pending issues (by default four times max_in_flight) have requests
+    queued.
+    """
+    def __init__(self, github, max_in_flight=32, max_pending=None):
+        self.github = github
+        self.max_in_flight = max_in_flight
+        self.max_pending = max_pending or max_in_flight * 4
+        # Requests handed to the threads; a condition rather than a
+        # semaphore so waiting for a free slot can be interrupted with Ctrl-C
+        self.outstanding = 0
+        self.slots = threading.Condition()
+        self.ready = Queue.Queue()
+        # ordering key -> requests waiting for the running one with that key
+        self.chains = {}
+        # keys with a failed request; anything queued for them is cancelled
+        self.failed = set()
+        self.closed = False
+        self.cancelling = False
+        self.threads = []
+        for i in range(max_in_flight):
+            t = threading.Thread(target=self.worker)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, key, func, *args):
+        """Queue func(*args); requests with the same key, unless it's None,
+        run in submission order.
+        """
+        if self.closed:
+            raise RuntimeError("AsyncGitHub is closed")
+        job = (key, Future(), func, args)
+        with self.slots:
+            while True:
+                if key in self.failed:
+                    break
+                if key is not None and key in self.chains:
+                    # runs when the requests before it are done
+                    self.chains[key].append(job)
+                    return job[1]
+                if self.outstanding < self.max_in_flight and \
+                        (key is None or len(self.chains) < self.max_pending):
+                    self.outstanding += 1
+                    if key is not None:
+                        self.chains[key] = []
+                    self.ready.put(job)
+                    return job[1]
+                self.slots.wait(1.0)
+        job[1].cancel("an earlier request for %s failed" % (key,))
+        return job[1]
+
+    def worker(self):
+        while True:
+            job = self.ready.get()
+            if job is None:
+                break
+            key, future, func, args = job
+            if self.cancelling:
+                future.cancel("client closed")
+            elif future.set_running():
+                try:
+                    result = func(*args)
+                except Exception, e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            self.finish(job)
+
+    def finish(self, job):
+        key, future = job[:2]
+        chain = []
+        with self.slots:
+            if key is not None:
+                chain = self.chains[key]
+                if future.error is None and chain:
+                    # the next request for the issue takes over the slot
+                    self.ready.put(chain.pop(0))
+                    return
+                del self.chains[key]
+                if future.error is not None:
+                    self.failed.add(key)
+            self.outstanding -= 1
+            self.slots.notify_all()
+        for waiting in chain:
+            waiting[1].cancel("an earlier request for %s failed" % (key,))
+
+    def issues(self, id_=None, query=None, data=None):
+        return self.submit(id_ and ('issue', id_), self.github.issues, id_, query, data)
+
+    def issue_comments(self, id_, query=None, data=None):
+        return self.submit(('issue', id_), self.github.issue_comments, id_, query, data)
+
+    def labels(self, query=None, data=None):
+        return self.submit(None, self.github.labels, query, data)
+
+    def milestones(self, query=None, data=None):
+        return self.submit(None, self.github.milestones, query, data)
+
+    def close(self, cancel=False):
+        """Wait for all queued requests, or with cancel only for the ones
+        already running, and stop the threads. Safe to call more than once.
+        """
+        self.closed = True
+        if cancel:
+            self.cancelling = True
+        with self.slots:
+            while self.outstanding:
+                self.slots.wait(1.0)
+        for t in self.threads:
+            self.ready.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
@@ -0,0 +1,103 @@
+import sqlite3
+import threading
+import time
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+class ResponseCache(object):
+    """GET responses kept on disk by URL together with their ETag and
+    Last-Modified validators.
+
+    A request for a cached URL is made conditional, and GitHub answers a
+    304 without a body, and without charging the rate limit, if nothing
+    changed. Only the headers needed to use the response again, like the
+    Link header of list pages, are kept. The least recently used responses
+    are evicted once the bodies take more than max_bytes.
+    """
+    kept_headers = ('etag', 'last-modified', 'link')
+
+    def __init__(self, path, max_bytes=256 << 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        try:
+            self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        except sqlite3.OperationalError, e:
+            raise RuntimeError("Could not open cache=%s e=%s" % (self.path, e))
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS response (url TEXT PRIMARY KEY, headers TEXT NOT NULL, '
+                          'body BLOB NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS response_used ON response (used)')
+        self.conn.commit()
+        self.size = self.conn.execute('SELECT coalesce(sum(size), 0) FROM response').fetchone()[0]
+        # The cache may have been filled with a larger max_bytes
+        with self.lock:
+            self.evict()
+            self.conn.commit()
+
+    def get(self, url):
+        """Return (headers, body) of the cached response, or None.
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT headers, body FROM response WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), str(row[1])
+
+    def validators(self, headers):
+        """Request headers that make a request for a cached response
+        conditional.
+        """
+        conditions = {}
+        if 'etag' in headers:
+            conditions['If-None-Match'] = headers['etag']
+        if 'last-modified' in headers:
+            conditions['If-Modified-Since'] = headers['last-modified']
+        return conditions
+
+    def touch(self, url):
+        """Mark the response as used, after GitHub said it's still current.
+        """
+        with self.lock:
+            self.conn.execute('UPDATE response SET used = ? WHERE url = ?', (time.time(), url))
+            self.conn.commit()
+
+    def put(self, url, headers, body):
+        """Keep the response if it has a validator and fits in the cache.
+        """
+        headers = dict([(name, value) for name, value in headers.items() if name in self.kept_headers])
+        if not self.validators(headers) or len(body) > self.max_bytes:
+            return
+        with self.lock:
+            row = self.conn.execute('SELECT size FROM response WHERE url = ?', (url,)).fetchone()
+            if row is not None:
+                self.size -= row[0]
+            self.conn.execute('INSERT OR REPLACE INTO response (url, headers, body, size, used) VALUES (?, ?, ?, ?, ?)',
+                              (url, json.dumps(headers), sqlite3.Binary(body), len(body), time.time()))
+            self.size += len(body)
+            self.evict()
+            self.conn.commit()
+
+    def evict(self):
+        # Called holding the lock
+        while self.size > self.max_bytes:
+            for url, size in self.conn.execute('SELECT url, size FROM response ORDER BY used LIMIT 100').fetchall():
+                if self.size <= self.max_bytes:
+                    break
+                self.conn.execute('DELETE FROM response WHERE url = ?', (url,))
+                self.size -= size
+
+    def invalidate(self, pattern):
+        """Drop every response whose URL matches the GLOB pattern.
+        """
+        with self.lock:
+            self.conn.execute('DELETE FROM response WHERE url GLOB ?', (pattern,))
+            self.conn.commit()
+            self.size = self.conn.execute('SELECT coalesce(sum(size), 0) FROM response').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,72 @@
+import sqlite3
+import threading
+
+class Journal(object):
+    """Local record of migration steps GitHub has acknowledged.
+
+    Each Trac ticket id is mapped to the GitHub issue number it was created
+    as, and every later step on that issue (update, comment, close) is
+    written once the API call returns. A restarted run loads the journal and
+    skips whatever is already recorded, without asking GitHub.
+
+    It also keeps named high-water marks, like the latest Trac change time
+    a completed run has seen, for syncing only what changed since.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        except sqlite3.OperationalError, e:
+            raise RuntimeError("Could not open journal=%s e=%s" % (self.path, e))
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS issue (tid INTEGER PRIMARY KEY, gid INTEGER NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS step (tid INTEGER NOT NULL, step TEXT NOT NULL, PRIMARY KEY (tid, step))')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS mark (name TEXT PRIMARY KEY, value INTEGER)')
+        self.conn.commit()
+        self.gids = dict(self.conn.execute('SELECT tid, gid FROM issue'))
+        self.steps = set(self.conn.execute('SELECT tid, step FROM step'))
+        self.marks = dict(self.conn.execute('SELECT name, value FROM mark'))
+
+    def get_gid(self, tid):
+        return self.gids.get(tid)
+
+    def set_gid(self, tid, gid):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO issue (tid, gid) VALUES (?, ?)', (tid, gid))
+            self.conn.commit()
+            self.gids[tid] = gid
+
+    def is_done(self, tid, step):
+        return (tid, step) in self.steps
+
+    def done(self, tid, step):
+        with self.lock:
+            self.conn.execute('INSERT OR IGNORE INTO step (tid, step) VALUES (?, ?)', (tid, step))
+            self.conn.commit()
+            self.steps.add((tid, step))
+
+    def undo(self, tid, step):
+        """Forget a step, for one that has to be done again, like closing a
+        reopened ticket.
+        """
+        with self.lock:
+            self.conn.execute('DELETE FROM step WHERE tid = ? AND step = ?', (tid, step))
+            self.conn.commit()
+            self.steps.discard((tid, step))
+
+    def get_mark(self, name):
+        return self.marks.get(name)
+
+    def set_marks(self, marks):
+        """Store a dict of high-water marks in one transaction.
+        """
+        with self.lock:
+            self.conn.executemany('INSERT OR REPLACE INTO mark (name, value) VALUES (?, ?)', marks.items())
+            self.conn.commit()
+            self.marks.update(marks)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
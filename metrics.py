@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# Runtime metrics for migrations: request counts and latency per endpoint,
+# retries, named counters and timers, wall time per phase and optional
+# cProfile dumps per phase.
+
+import os, re, time
+import threading
+import logging
+import contextlib
+import cProfile
+import pstats
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+class Metrics(object):
+    """Thread-safe collection of everything measured during a run.
+    """
+    # Upper bounds in seconds of the request latency histogram buckets
+    latency_buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, profile_dir=None):
+        self.profile_dir = profile_dir
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = {}
+        self.retries = {}
+        self.counters = {}
+        self.timers = {}
+        self.phases = []
+        self.profiles = None
+
+    def endpoint(self, method, path):
+        """Group a request path like /repos/o/r/issues/12/comments?page=2
+        under "POST issues/:n/comments".
+        """
+        path = path.split('?')[0]
+        path = re.sub(r'^.*?/repos/[^/]+/[^/]+/?', '', path)
+        return "%s %s" % (method, re.sub(r'/[0-9]+', '/:n', path))
+
+    def record_request(self, method, path, seconds, status):
+        """Add one HTTP attempt; status is None for network errors.
+        """
+        name = self.endpoint(method, path)
+        with self.lock:
+            stats = self.requests.get(name)
+            if stats is None:
+                stats = self.requests[name] = {'count': 0, 'errors': 0, 'seconds': 0.0,
+                                               'max': 0.0, 'buckets': [0] * (len(self.latency_buckets) + 1)}
+            stats['count'] += 1
+            if status is None or status >= 400:
+                stats['errors'] += 1
+            stats['seconds'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            for i, bound in enumerate(self.latency_buckets):
+                if seconds <= bound:
+                    break
+            else:
+                i = len(self.latency_buckets)
+            stats['buckets'][i] += 1
+
+    def record_retry(self, method, path):
+        name = self.endpoint(method, path)
+        with self.lock:
+            self.retries[name] = self.retries.get(name, 0) + 1
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a phase of the run and, if profiling, dump the cProfile
+        stats of the main thread plus any worker threads that called
+        start_thread_profile to profile_dir/name.prof.
+        """
+        logging.info("Phase %s started" % name)
+        if self.profile_dir:
+            profile = cProfile.Profile()
+            self.profiles = [profile]
+            profile.enable()
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                self.phases.append({'name': name, 'seconds': elapsed})
+            logging.info("Phase %s finished in %.1fs" % (name, elapsed))
+            if self.profile_dir:
+                self.profiles[0].disable()
+                stats = pstats.Stats(self.profiles[0])
+                for profile in self.profiles[1:]:
+                    stats.add(profile)
+                self.profiles = None
+                if not os.path.isdir(self.profile_dir):
+                    os.makedirs(self.profile_dir)
+                stats.dump_stats(os.path.join(self.profile_dir, "%s.prof" % name))
+
+    def start_thread_profile(self):
+        """Profile the calling worker thread as part of the current phase.
+        Returns the profiler to hand to stop_thread_profile, or None.
+        """
+        if self.profiles is None:
+            return None
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+        return profile
+
+    def stop_thread_profile(self, profile):
+        if profile is not None:
+            profile.disable()
+
+    def report(self):
+        with self.lock:
+            elapsed = time.time() - self.started
+            requests = dict([(name, dict(stats)) for name, stats in self.requests.items()])
+            for stats in requests.values():
+                stats['mean'] = stats['count'] and stats['seconds'] / stats['count']
+                stats['buckets'] = dict(zip([str(b) for b in self.latency_buckets] + ['inf'], stats['buckets']))
+            return {'started': self.started,
+                    'seconds': elapsed,
+                    'phases': list(self.phases),
+                    'requests': requests,
+                    'total_requests': sum([stats['count'] for stats in requests.values()]),
+                    'retries': dict(self.retries),
+                    'counters': dict(self.counters),
+                    'timers': dict(self.timers),
+                    }
+
+    def write_report(self, path, **extra):
+        report = self.report()
+        report.update(extra)
+        fh = open(path, "w")
+        json.dump(report, fh, indent=2, sort_keys=True)
+        fh.close()
+        return report
+
+class Progress(object):
+    """Logs a progress line with rate and ETA every interval seconds from a
+    background thread while a phase runs.
+    """
+    def __init__(self, name, total=None, interval=30):
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.started = time.time()
+        # Named after the thread running the phase, which a batch of
+        # projects names after its project
+        self.thread = threading.Thread(target=self.run,
+                                       name="%s %s" % (threading.current_thread().name, name))
+        self.thread.daemon = True
+
+    def __enter__(self):
+        if self.interval > 0:
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.log()
+
+    def update(self, n=1):
+        with self.lock:
+            self.done += n
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.log()
+
+    def log(self):
+        elapsed = time.time() - self.started
+        rate = elapsed and self.done / elapsed
+        line = "%s: %d" % (self.name, self.done)
+        if self.total:
+            line += "/%d" % self.total
+        line += " (%.1f/s)" % rate
+        if self.total and rate:
+            remaining = max(self.total - self.done, 0) / rate
+            line += ", ETA %d:%02d:%02d" % (remaining // 3600, remaining % 3600 // 60, remaining % 60)
+        logging.info(line)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# Map svn revision numbers to git commits, for a git repository converted
+# from svn whose commit messages contain a line like "svn-revision: r1234".
+
+import os
+import logging
+import subprocess as sub
+
+def git_output(gitdir, *args):
+    p = sub.Popen(["git"] + list(args), cwd=gitdir, stdout=sub.PIPE, stderr=sub.PIPE)
+    stdout, stderr = p.communicate()
+    if p.returncode != 0:
+        raise RuntimeError("git %s failed in %s: %s" % (" ".join(args), gitdir, stderr.strip()))
+    return stdout.strip()
+
+def scan_git_log(gitdir):
+    """Build the map by streaming git log, reading one line at a time.
+    Only the commit id and message are requested, and git itself skips the
+    commits without an svn-revision line.
+    """
+    rmap = {}
+    p = sub.Popen(["git", "log", "--grep=svn-revision:", "--format=%x00%H%n%B"],
+                  cwd=gitdir, stdout=sub.PIPE)
+    git = None
+    for line in p.stdout:
+        if line.startswith("\0"):
+            git = line[1:].strip()
+        elif git and "svn-revision:" in line:
+            try:
+                svn = int(line[line.index("svn-revision:"):].split()[1][1:])
+            except (IndexError, ValueError):
+                continue
+            rmap[svn] = git
+            git = None
+    p.stdout.close()
+    if p.wait() != 0:
+        raise RuntimeError("git log failed in %s" % gitdir)
+    return rmap
+
+def load_revision_map(path):
+    """Load a map saved by save_revision_map; returns (rmap, head).
+    """
+    rmap = {}
+    head = None
+    fh = open(path)
+    for line in fh:
+        if line.startswith("# HEAD "):
+            head = line[7:].strip()
+        elif line.startswith("r"):
+            svn, git = line.split()
+            rmap[int(svn[1:])] = git
+    fh.close()
+    return rmap, head
+
+def save_revision_map(path, rmap, head=None):
+    """Write the map as "r1234 sha1" lines, written to a temporary file
+    first so a partial write never replaces a good map.
+    """
+    tmp = path + ".tmp"
+    fh = open(tmp, "w")
+    if head:
+        fh.write("# HEAD %s\n" % head)
+    for svn in sorted(rmap):
+        fh.write("r%d %s\n" % (svn, rmap[svn]))
+    fh.close()
+    os.rename(tmp, path)
+
+def svn_git_revision_map(gitdir, cache=True):
+    """Return the svn to git map for the repository in gitdir.
+    The map is cached inside the repository's .git directory and reused as
+    long as HEAD hasn't moved.
+    """
+    git_dir, head = git_output(gitdir, "rev-parse", "--git-dir", "HEAD").splitlines()
+    cache_path = None
+    if cache:
+        cache_path = os.path.join(gitdir, git_dir, "svn-revision-map")
+        if os.path.exists(cache_path):
+            rmap, cached_head = load_revision_map(cache_path)
+            if cached_head == head:
+                logging.debug("Using cached revision map %s" % cache_path)
+                return rmap
+    rmap = scan_git_log(gitdir)
+    if cache_path:
+        try:
+            save_revision_map(cache_path, rmap, head)
+        except IOError, e:
+            logging.warning("Could not cache revision map in %s: %s" % (cache_path, e))
+    return rmap
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Migrate the tickets of many Trac environments into their GitHub
+# repositories in one process. Every project is migrated by
+# trac-tickets-to-gh.py, but all of them share one pool of connections, one
+# rate limit budget, one response cache and one svn to git revision map
+# per git repository.
+
+import os, sys, time
+import threading
+import Queue
+import urlparse
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import logging
+from optparse import OptionParser
+
+from github import GitHub, ConnectionPool, RateLimiter
+from httpcache import ResponseCache
+from revmap import svn_git_revision_map
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'trac-tickets-to-gh.py')
+
+def read_manifest(path):
+    """Projects of the manifest, one JSON object per line like
+    {"trac_db": "a/trac.db", "repo": "org/a", "git_dir": "a.git",
+     "options": ["--attachments", "a/env", "--attachments-git", "a.git"]}
+    Only trac_db and repo are required; name defaults to the repo. Blank
+    lines and lines starting with # are skipped.
+    """
+    projects = []
+    fh = open(path)
+    try:
+        for number, line in enumerate(fh):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                project = json.loads(line)
+            except ValueError, e:
+                raise RuntimeError("%s line %d: %s" % (path, number + 1, e))
+            if not project.get('trac_db') or not project.get('repo'):
+                raise RuntimeError("%s line %d: trac_db and repo are required" % (path, number + 1))
+            projects.append(project)
+    finally:
+        fh.close()
+    return projects
+
+class Batch(object):
+    """What the projects share. Each git repository is only parsed for
+    its revision map once, however many projects use it.
+    """
+    def __init__(self, pool, limiter, cache):
+        self.pool = pool
+        self.limiter = limiter
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.revision_maps = {}
+
+    def revision_map(self, git_dir):
+        git_dir = os.path.abspath(git_dir)
+        with self.lock:
+            entry = self.revision_maps.get(git_dir)
+            if entry is None:
+                entry = self.revision_maps[git_dir] = [threading.Lock(), None]
+        with entry[0]:
+            if entry[1] is None:
+                entry[1] = svn_git_revision_map(git_dir)
+        return entry[1]
+
+class Project(object):
+    """One migration of the batch. The script runs in a namespace of its
+    own, where it finds the project as 'batch' and takes its command line
+    and the shared objects from it.
+    """
+    def __init__(self, batch, name, argv):
+        self.name = name
+        self.argv = argv
+        self.pool = batch.pool
+        self.limiter = batch.limiter
+        self.cache = batch.cache
+        self.revision_map = batch.revision_map
+        self.namespace = {}
+        self.started = None
+        self.finished = None
+        self.status = None
+
+    def run(self, code):
+        self.namespace = {'__name__': '__batch__', '__file__': script, 'batch': self}
+        self.started = time.time()
+        logging.info("Migrating %s" % self.name)
+        try:
+            exec code in self.namespace
+            self.status = 0
+        except SystemExit, e:
+            self.status = e.code or 0
+        except Exception:
+            logging.exception("Migration of %s failed" % self.name)
+            self.status = 1
+        self.finished = time.time()
+        logging.info("Migration of %s finished with status %s in %.1fs" % (
+                self.name, self.status, self.finished - self.started))
+
+    def state(self):
+        if self.started is None:
+            return 'queued'
+        if self.finished is None:
+            return 'running'
+        return self.status == 0 and 'done' or 'failed'
+
+    def report(self):
+        metrics = self.namespace.get('metrics')
+        report = {'name': self.name,
+                  'state': self.state(),
+                  'status': self.status,
+                  'seconds': self.started and (self.finished or time.time()) - self.started,
+                  }
+        if metrics is not None:
+            report['metrics'] = metrics.report()
+        return report
+
+def log_progress(projects):
+    """Log a line for every running project and a count of the others.
+    """
+    states = {}
+    for project in projects:
+        report = project.report()
+        states[report['state']] = states.get(report['state'], 0) + 1
+        if report['state'] != 'running' or 'metrics' not in report:
+            continue
+        metrics = report['metrics']
+        phase = metrics['phases'] and metrics['phases'][-1]['name'] or 'starting'
+        counters = ", ".join(["%s=%d" % item for item in sorted(metrics['counters'].items())])
+        logging.info("%s: after %s, %d requests, %s" % (
+                project.name, phase, metrics['total_requests'], counters or "nothing done yet"))
+    logging.info("Projects: %s" % ", ".join(["%d %s" % (states[state], state) for state in sorted(states)]))
+
+usage = """
+  %prog [options] manifest github_username github_password [-- options for all projects]
+
+  Migrate the tickets of every project in the manifest with
+  trac-tickets-to-gh.py, in one process. The manifest has one JSON object per
+  line like:
+
+  {"trac_db": "alpha/trac.db", "repo": "myorg/alpha", "git_dir": "alpha.git"}
+  {"trac_db": "beta/trac.db", "repo": "myorg/beta", "options": ["-k"]}
+
+  git_dir is passed as -r, options are added to the command line of that
+  project only, and options after -- to every project, for example:
+
+  ./trac-batch-to-gh.py -n 8 projects.jsonl github_username "github_password" -- -b import
+
+  Up to --parallel projects are migrated at the same time. Issues of a single
+  repository have to be created one after another to keep the Trac numbers,
+  so running several projects side by side keeps the request budget in use.
+  All projects share one pool of --connections connections to GitHub and one
+  rate limiter, since the rate limit is counted per account, and with --cache
+  one response cache. Projects using the same git repository share its
+  revision map.
+
+  Each project keeps its own journal and report next to its Trac database,
+  so re-running the batch resumes every project where it stopped. A line
+  for every running project is logged every --progress-interval seconds, and
+  the state and metrics of all projects are written to the --report file.
+  Bundles can't be exported in a batch.
+"""
+
+parser = OptionParser(usage=usage)
+parser.add_option('-q', '--quiet', action="store_true", default=False,
+                  help='Decrease logging of activity')
+parser.add_option('-n', '--parallel', action="store", default=4, type=int,
+                  help='Number of projects migrated at the same time (default: %default)')
+parser.add_option('--connections', action="store", default=16, type=int,
+                  help='Size of the connection pool shared by all projects (default: %default)')
+parser.add_option('--api-url', action="store", default=GitHub.api_url,
+                  help='GitHub API root URL (default: %default)')
+parser.add_option('--cache', action="store", default="",
+                  help='Response cache shared by all projects, see trac-tickets-to-gh.py --cache')
+parser.add_option('--cache-size', action="store", default=256, type=int,
+                  help='Megabytes of responses kept in the --cache file (default: %default)')
+parser.add_option('--report', action="store", default="",
+                  help='Write the state and metrics of every project as JSON to this file '
+                       '(default: next to the manifest)')
+parser.add_option('--progress-interval', action="store", default=30, type=int,
+                  help='Seconds between progress lines, 0 to disable (default: %default)')
+
+(options, args) = parser.parse_args()
+if len(args) < 3:
+    parser.error('Wrong number of arguments')
+manifest, github_username, github_password = args[:3]
+common = args[3:]
+if '--export' in common:
+    parser.error('Bundles can\'t be exported in a batch')
+
+# Thread names are project names while they run
+logging.basicConfig(level=options.quiet and logging.INFO or logging.DEBUG,
+                    format="%(threadName)s: %(levelname)s: %(message)s")
+
+try:
+    entries = read_manifest(manifest)
+except (IOError, RuntimeError), e:
+    parser.error(str(e))
+
+parts = urlparse.urlsplit(options.api_url)
+pool = ConnectionPool(parts.scheme, parts.hostname, parts.port,
+                      maxsize=options.connections)
+cache = None
+if options.cache:
+    cache = ResponseCache(options.cache, options.cache_size << 20)
+batch = Batch(pool, RateLimiter(), cache)
+
+projects = []
+for entry in entries:
+    argv = common + entry.get('options', []) + ['--api-url', options.api_url]
+    if entry.get('git_dir'):
+        argv += ['-r', entry['git_dir']]
+    argv += [entry['trac_db'], github_username, github_password, entry['repo']]
+    projects.append(Project(batch, entry.get('name') or entry['repo'], argv))
+
+# Compiled once; every project runs it in its own namespace
+code = compile(open(script).read(), script, 'exec')
+queue = Queue.Queue()
+for project in projects:
+    queue.put(project)
+def worker():
+    while True:
+        try:
+            project = queue.get_nowait()
+        except Queue.Empty:
+            break
+        threading.current_thread().name = project.name
+        project.run(code)
+threads = []
+for i in range(min(options.parallel, len(projects))):
+    t = threading.Thread(target=worker)
+    t.daemon = True
+    t.start()
+    threads.append(t)
+started = last = time.time()
+while threads:
+    # join with a timeout so Ctrl-C still gets through
+    threads[0].join(1)
+    threads = [t for t in threads if t.is_alive()]
+    if threads and options.progress_interval and time.time() - last >= options.progress_interval:
+        log_progress(projects)
+        last = time.time()
+
+pool.close()
+if cache is not None:
+    cache.close()
+if not options.report:
+    options.report = manifest + '.report.json'
+fh = open(options.report, "w")
+json.dump({'seconds': time.time() - started,
+           'rate_limit': batch.limiter.budget(),
+           'projects': [project.report() for project in projects],
+           }, fh, indent=2, sort_keys=True)
+fh.close()
+failed = [project.name for project in projects if project.status != 0]
+logging.info("Migrated %d projects in %.1fs; report written to %s" % (
+        len(projects) - len(failed), time.time() - started, options.report))
+if failed:
+    logging.error("Failed projects: %s" % ", ".join(failed))
+    sys.exit(1)
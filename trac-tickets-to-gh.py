@@ -2,52 +2,108 @@
 # -*- coding: utf-8 -*-
 # Migrate trac tickets from DB into GitHub using v3 API.
 # Transform milestones to milestones, components to labels.
-# The code merges milestones and labels does NOT attempt to prevent
-# duplicating tickets so you'll get multiples if you run repeatedly.
+# The code merges milestones and labels. Progress is recorded in a local
+# journal so re-running after a crash skips tickets, comments and closes
+# that already made it to GitHub.
 # See API docs: http://developer.github.com/v3/issues/
 
 # TODO:
-# - it's not getting ticket *changes* from 'comments', like milestone changed.
-# - should I be migrating Trac 'keywords' to Issue 'labels'?
 # - list Trac users, get GitHub collaborators, define a mapping for issue assignee.
 
-import sys, re, time
+import os, sys, re, time
 import datetime
-# TODO: conditionalize and use 'json'
+import hashlib
+import threading
+import Queue
+import gzip
+import urllib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+try:
+    import json
+except ImportError:
+    import simplejson as json
 import logging
 from optparse import OptionParser
-import sqlite3
 
-from github import GitHub
+from github import GitHub, AsyncGitHub, IssueImporter
+from attachments import attachment_file, GitAttachmentStore, DirectoryAttachmentStore
+from journal import Journal
+from httpcache import ResponseCache
+from tracdb import Trac
+from metrics import Metrics, Progress
+from wikiconvert import WikiConverter
+from revmap import svn_git_revision_map, load_revision_map, save_revision_map
 
-class Trac(object):
-    # We don't have a way to close (potentially nested) cursors
+# Set by trac-batch-to-gh.py when this runs as one of many projects in the
+# same process: the command line of the project and the connection pool,
+# rate limiter, response cache and revision maps shared by all of them.
+batch = globals().get('batch')
 
-    def __init__(self, trac_db_path):
-        self.trac_db_path = trac_db_path
-        try:
-            self.conn = sqlite3.connect(self.trac_db_path)
-        except sqlite3.OperationalError, e:
-            raise RuntimeError("Could not open trac db=%s e=%s" % (
-                    self.trac_db_path, e))
-
-    def sql(self, sql_query):
-        """Create a new connection, send the SQL query, return response.
-        We need unique cursors so queries in context of others work.
+class TracTicket(object):
+    @classmethod
+    def where(cls, start=1, end=-1, since=None):
+        """WHERE clause and parameters selecting the tickets in the id range
+        and, given the high-water marks of an earlier run, only those
+        created, changed or given an attachment since. ticket_change.time
+        is indexed in Trac; ticket.changetime and attachment.time are not,
+        so those two tables are scanned.
         """
-        cursor = self.conn.cursor()
-        cursor.execute(sql_query)
-        return cursor
-
-    def close(self):
-        self.conn.close()
+        where = ' WHERE id >= ?'
+        params = [start]
+        if end > -1:
+            where += ' AND id <= ?'
+            params.append(end)
+        if since:
+            where += (' AND id IN (SELECT ticket FROM ticket_change WHERE time > ?'
+                      ' UNION SELECT id FROM ticket WHERE changetime > ?'
+                      ' UNION SELECT CAST(id AS INTEGER) FROM attachment WHERE type = ? AND time > ?)')
+            params += [since['ticket_change.time'], since['ticket.changetime'],
+                       'ticket', since['attachment.time']]
+        return where, params
 
-class TracTicket(object):
     @classmethod
-    def iter_tickets(cls):
-        tickets = trac.sql('SELECT id, summary, description , owner, reporter, milestone, component, status, time FROM ticket ORDER BY id') # LIMIT 5
+    def iter_tickets(cls, start=1, end=-1, comments=False, since=None):
+        """Yield tickets in id order, optionally with their comments attached.
+        Comments come from a single cursor over ticket_change sorted the same
+        way as the tickets and merged in step, so only one ticket's comments
+        are held in memory at a time. Rows sharing a time and author are one
+        change in Trac; each becomes a single (author, time, comment, field
+        changes) entry in ticket.comments. With since, see where, only the
+        changes made after the marks are attached.
+        """
+        where, params = cls.where(start, end, since)
+        tickets = trac.sql('SELECT id, summary, description , owner, reporter, milestone, component, status, time, keywords FROM ticket' + where + ' ORDER BY id', params)
+        if not comments:
+            for values in tickets:
+                yield TracTicket(*values)
+            return
+        # Without an index on ticket_change.ticket sqlite sorts the rows once
+        # for this query, instead of scanning the table for every ticket.
+        # Fields starting with an underscore hold comment edit history.
+        where, params = cls.where(start, end)
+        if since:
+            where += ' AND time > ?'
+            params.append(since['ticket_change.time'])
+        changes = trac.sql('SELECT ticket, author, time, field, oldvalue, newvalue FROM ticket_change' + where.replace('id', 'ticket') + " AND substr(field, 1, 1) != '_' ORDER BY ticket, time, author", params)
+        change = next(changes, None)
         for values in tickets:
-            yield TracTicket(*values)
+            ticket = TracTicket(*values)
+            while change is not None and change[0] < ticket.tid:
+                change = next(changes, None)
+            ticket.attachments = attachment_links.get(ticket.tid, [])
+            group = None
+            while change is not None and change[0] == ticket.tid:
+                tid, author, time_t, field, old, new = change
+                if group is None or group[:2] != [author, time_t]:
+                    group = [author, time_t, '', []]
+                    ticket.comments.append(group)
+                if field == 'comment':
+                    group[2] = new or ''
+                elif old != new:
+                    group[3].append((field, old, new))
+                change = next(changes, None)
+            yield ticket
     
     @classmethod
     def get_dummy_data(cls):
@@ -62,46 +118,68 @@ class TracTicket(object):
         dummy = cls.get_dummy_data()
         dummy_issue = github.issues(data=dummy)
         gid = dummy_issue['number']
-        github.issues(id_=gid, data={'state': 'closed'})
+        # The state is part of the create request, but only close it
+        # separately if GitHub didn't honor it
+        if dummy_issue.get('state') != 'closed':
+            github.issues(id_=gid, data={'state': 'closed'})
+        metrics.count('dummies_created')
         logging.info("Added dummy ticket %d to maintain numbering with Trac" % gid)
         return gid
     
-    @classmethod
-    def replace_with_dummy(cls, gid):
-        dummy = cls.get_dummy_data()
-        github.issues(id_=gid, data=dummy)
-        logging.info("Replaced existing ticket %d with dummy data to maintain numbering with Trac" % gid)
-    
     def __init__(self, *values):
-        self.tid, self.summary, self.description, self.owner, self.reporter, self.milestone, self.component, self.status, self.time = values
-    
-    def get_github_summary_data(self):
-        issue = {'title': ticket.summary}
-        return issue
+        self.tid, self.summary, self.description, self.owner, self.reporter, self.milestone, self.component, self.status, self.time, self.keywords = values
+        self.comments = []
+        self.attachments = []
     
-    def get_github_data(self, milestone_map, labels):
-        issue = {'title': ticket.summary}
-        text = self.get_description()
-        if text:
-            issue['body'] = text
-        text = self.milestone.strip()
-        if text:
-            m = milestone_map.get(text)
-            if m:
-                issue['milestone'] = m
-        if self.component:
-            if self.component not in labels:
-                # GitHub creates the 'url' and 'color' fields for us
-                github.labels(data={'name': ticket.component})
-                labels[ticket.component] = 'CREATED' # keep track of it so we don't re-create it
-                logging.debug("adding component as new label=%s" % ticket.component)
-            issue['labels'] = [ticket.component]
-            
-        # We have to create/map Trac users to GitHub usernames before we can assign
-        # them to tickets; don't see how to do that conveniently now.
-        # if owner.strip():
-        #     ticket['assignee'] = owner.strip()
-        return issue
+    def render(self, description=True):
+        """Convert the ticket and its comments to markdown.
+        Returns a dict holding everything needed to upload the ticket, in
+        the form stored in a TicketBundle. Without description the body is
+        left out, for issues that already have it.
+        """
+        comments = []
+        steps = set()
+        for author, time_t, body, changes in self.comments:
+            body = body.strip()
+            if body or changes:
+                # prefix comment with author as git doesn't keep them separate
+                text = wiki.convert_author(author, "comment by")
+                text += wiki.convert_time(time_t)
+                if changes:
+                    text += "\n\n" + wiki.convert_changes(changes)
+                    if body:
+                        text += "\n\n"
+                text += wiki.convert(body)
+                # Changes by different authors can share a time; only the
+                # later ones get a suffix so older journals still match
+                step = 'comment:%s' % time_t
+                n = 1
+                while step in steps:
+                    n += 1
+                    step = 'comment:%s:%d' % (time_t, n)
+                steps.add(step)
+                comments.append({'step': step, 'time': time_t, 'body': text})
+        for author, time_t, filename, size, description, url in self.attachments:
+            text = wiki.convert_author(author, "attachment by")
+            text += wiki.convert_time(time_t)
+            text += "[%s](%s) (%.1f KB)" % (filename, url, (size or 0) / 1024.0)
+            if description and description.strip():
+                text += "\n\n" + wiki.convert(description.strip())
+            comments.append({'step': 'attachment:%s' % filename, 'time': time_t, 'body': text})
+        if self.attachments:
+            comments.sort(key=lambda comment: comment['time'])
+        return {'type': 'ticket',
+                'tid': self.tid,
+                'title': self.summary,
+                'body': description and self.get_description() or None,
+                'owner': self.owner.strip(),
+                'milestone': self.milestone.strip(),
+                'component': self.component,
+                'keywords': self.keywords or '',
+                'status': self.status,
+                'time': self.time,
+                'comments': comments,
+                }
     
     def get_description(self):
         r = self.reporter.strip()
@@ -110,92 +188,563 @@ class TracTicket(object):
         text += wiki.convert(self.description.strip())
         return text
 
-class WikiConverter(object):
-    # Regexps to convert to markdown borrowed and modified from http://zim-wiki.org/wiki/doku.php?id=script_to_convert_moinmoin_pages_to_zim
-    regexp = (
-        ('\[(http[^ ]*) ([^\]]*)\]', '[\\2](\\1)'),        # web link
-#        ('\[(http.*)\]', '[[\\1]]'),                  # web link
-        ('^\s\s\s\s\*', '\t\t\t*'),
-        ('^\s\s\s\*', '\t\t*'),
-        ('^\s\s\*', '\t*'),
-        ('^\s\*', '*'),                           # lists must have 2 whitespaces before the asterisk
-        ('^\s\s\s\s[0-9]\.', '    1.'),
-        ('^\s\s[0-9]\.', '  1.'),
-        ('^\s[0-9]\.', '1.'),
-        ('\'{5}([^\']*)\'{5}', '**//\\1//**'),          # bold and italic
-        ('\'{3}([^\']*)\'{3}', '**\\1**'),              # bold
-        ('\'{2}([^\']*)\'{2}', '//\\1//'),              # italic
-        ('^\s*\{{3}\s*$', '```'),                              # open code/verbatim line segment
-        ('^\s*\}{3}\s*$', '```'),                              # close code/verbatim line segment
-        ('\{{3}', '`'),                              # open code/verbatim line segment
-        ('\}{3}', '`'),                              # close code/verbatim line segment
-    )
-    
-    def __init__(self, rev_map):
-        self.svn_to_git = rev_map
-    
-    def convert_line(self, line):
-        for item in self.regexp:
-            line = re.sub(item[0], item[1], line)
-        match = re.search("\(In \[([0-9]+)\]\)(.+)", line)
-        if match:
-            rev = int(match.group(1))
-            git = self.svn_to_git.get(rev, "[old svn rev%d]" % rev)
-            line = "%s%s" % (git, match.group(2))
-            print "Found rev %d: %s" % (rev, line)
-        match = re.search("(.+)r([0-9]+)(.+)", line)
-        if match:
-            rev = int(match.group(2))
-            git = self.svn_to_git.get(rev, "[old svn rev%d]" % rev)
-            line = "%s%s%s" % (match.group(1), git, match.group(3))
-            print "Found rev %d: %s" % (rev, line)
-        return line
-    
-    def convert(self, text):
-        lines = []
-        for line in text.splitlines():
-            lines.append(self.convert_line(line))
-        return "\n".join(lines)
-    
-    def convert_author(self, r, intro="reported by"):
-        # FIXME: modify this list to treat any of the entries as yourself;
-        # otherwise the author will be annotated in the ticket.
-        
-        # Author email addresses are truncated to prevent spam to them
-        if r and r not in ["anonymous"]:
-            if "@" in r:
-                name, domain = r.split("@")
-                r = "%s@..." % name
-            text = "**[%s %s]** " % (intro, r)
+class TicketBundle(object):
+    """Rendered milestones and tickets stored as one JSON object per line,
+    gzip compressed if the file name ends in .gz. Tickets are written in id
+    order so they can be uploaded in a single pass. The header line holds an
+    index of (tid, component, keywords, milestone) for every ticket, so
+    counting tickets and collecting labels doesn't read the whole bundle.
+    """
+    version = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.index = None
+
+    def open(self, mode):
+        if self.path.endswith('.gz'):
+            return gzip.open(self.path, mode)
+        return open(self.path, mode)
+
+    def write(self, milestones, ticket_lines, index):
+        """Write the milestone dicts and the already encoded ticket lines,
+        with the index of the tickets in the header (see get_index).
+        The bundle is written to a temporary name and renamed when complete.
+        """
+        final = self.path
+        tmp = self.path = final + '.tmp' + os.path.splitext(final)[1]
+        try:
+            fh = self.open('wb')
+            count = 0
+            try:
+                fh.write(json.dumps({'type': 'bundle', 'version': self.version, 'index': index},
+                                   separators=(',', ':')) + "\n")
+                for milestone in milestones:
+                    fh.write(json.dumps(milestone, separators=(',', ':')) + "\n")
+                for line in ticket_lines:
+                    fh.write(line + "\n")
+                    count += 1
+            finally:
+                fh.close()
+        except BaseException:
+            # A partial bundle must never be mistaken for a complete one
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        finally:
+            self.path = final
+        os.rename(tmp, final)
+        return count
+
+    def read_header(self, fh):
+        header = json.loads(fh.readline())
+        if header.get('type') != 'bundle' or header.get('version') != self.version:
+            raise RuntimeError("%s is not a version %d ticket bundle" % (self.path, self.version))
+        return header
+
+    def get_index(self):
+        """[tid, component, keywords, milestone] of every ticket, from the
+        header, or from one pass over the tickets of bundles exported
+        without an index.
+        """
+        if self.index is None:
+            fh = self.open('rb')
+            try:
+                self.index = self.read_header(fh).get('index')
+            finally:
+                fh.close()
+            if self.index is None:
+                self.index = [[ticket['tid'], ticket['component'], ticket['keywords'], ticket['milestone']]
+                              for ticket in self.iter_records('ticket')]
+        return self.index
+
+    def iter_records(self, type_):
+        fh = self.open('rb')
+        try:
+            self.read_header(fh)
+            for line in fh:
+                record = json.loads(line)
+                if record['type'] == type_:
+                    yield record
+        finally:
+            fh.close()
+
+    def iter_milestones(self):
+        return self.iter_records('milestone')
+
+    def iter_tickets(self, start=1, end=-1, comments=False):
+        for ticket in self.iter_records('ticket'):
+            if ticket['tid'] < start:
+                continue
+            if end > -1 and ticket['tid'] > end:
+                break
+            if not comments:
+                ticket['comments'] = []
+            yield ticket
+
+def render_ticket(ticket):
+    """Process pool worker to encode one ticket as a bundle line.
+    """
+    return json.dumps(ticket.render(), separators=(',', ':'))
+
+def export_bundle(path, processes):
+    """Render all Trac milestones and tickets into a TicketBundle, using a
+    pool of processes for the wiki conversion.
+    """
+    milestones = [{'type': 'milestone', 'name': name, 'description': description,
+                   'due': due, 'completed': completed}
+                  for name, description, due, completed in iter_trac_milestones()]
+    where, params = TracTicket.where(options.ticket_start, options.ticket_end)
+    index = [[tid, component, keywords or '', (milestone or '').strip()]
+             for tid, component, keywords, milestone
+             in trac.sql('SELECT id, component, keywords, milestone FROM ticket' + where + ' ORDER BY id', params)]
+    pool = multiprocessing.Pool(processes)
+    batch_size = processes * 64
+    def rendered():
+        # Tickets have to be read on this thread because of sqlite, so the
+        # next batch is read while the pool renders the current one.
+        tickets = TracTicket.iter_tickets(options.ticket_start, options.ticket_end, comments=True)
+        pending = None
+        while True:
+            batch = [ticket for i, ticket in zip(xrange(batch_size), tickets)]
+            if pending is not None:
+                for line in pending.get():
+                    yield line
+            if not batch:
+                break
+            pending = pool.map_async(render_ticket, batch, chunksize=32)
+    try:
+        count = TicketBundle(path).write(milestones, rendered(), index)
+    finally:
+        pool.terminate()
+    return count
+
+def migrate_attachments(env_path, store, base_url, skip=None):
+    """Store the files of the ticket attachments in the selected range and
+    return {tid: [(author, time, filename, size, description, url)]} for
+    linking them from the tickets. Attachments of tickets for which skip(tid)
+    is true are left out, and when syncing the ones added before the marks.
+    """
+    links = {}
+    where = ' WHERE type = ?'
+    params = ['ticket']
+    if since:
+        where += ' AND time > ?'
+        params.append(since['attachment.time'])
+    rows = trac.sql('SELECT id, filename, size, time, description, author FROM attachment' + where + ' ORDER BY time', params)
+    for id_, filename, size, time_t, description, author in rows:
+        try:
+            tid = int(id_)
+        except ValueError:
+            continue
+        if tid < options.ticket_start or (options.ticket_end > -1 and tid > options.ticket_end):
+            continue
+        if skip is not None and skip(tid):
+            continue
+        path = attachment_file(env_path, 'ticket', id_, filename)
+        if path is None:
+            logging.warning("Attachment %s of ticket %d is missing" % (filename, tid))
+            metrics.count('attachments_missing')
+            continue
+        if options.verify:
+            name = store.lookup(path, filename)
         else:
-            text = ""
-        return text
-    
-    def convert_time(self, t):
+            name = store.add(path, filename)
+        url = base_url + urllib.quote(name.encode('utf-8'))
+        links.setdefault(tid, []).append((author, time_t, filename, size, description, url))
+        metrics.count('attachments')
+    return links
+
+def load_attachments(skip=None):
+    """Migrate the attachments if asked to, see migrate_attachments.
+    """
+    if not options.attachments:
+        return {}
+    if options.attachments_git:
+        store = GitAttachmentStore(options.attachments_git, options.attachments_branch)
+    else:
+        store = DirectoryAttachmentStore(options.attachments_dir)
+    logging.info("Storing Trac attachments from %s..." % options.attachments)
+    with metrics.phase('attachments'):
         try:
-            return "*[Trac time %s]* " % time.strftime("%Y%m%d %H%M%SZ", time.gmtime(int(t)))
-        except:
-            return ""
+            links = migrate_attachments(options.attachments, store, options.attachments_url, skip)
+        finally:
+            store.close()
+    logging.info("Linked %d attachments, stored %d new files" % (
+            sum([len(files) for files in links.values()]), store.added))
+    return links
 
-def svn_git_revision_map(gitdir):
-    rmap = {}
-    import subprocess as sub
-    p = sub.Popen(["git", "log"], cwd=gitdir, stdout=sub.PIPE, stderr=sub.PIPE)
-    stdout, stderr = p.communicate()
-    for line in stdout.splitlines():
-        #print line
-        if line.startswith("commit "):
-            git = line[7:]
-        elif "svn-revision:" in line:
-            svn = int(line.split()[1][1:])
-            rmap[svn] = git
-            git = None
-    #print rmap
-    return rmap
+def iter_trac_milestones():
+    if options.upload:
+        for m in bundle.iter_milestones():
+            yield m['name'], m['description'], m['due'], m['completed']
+    else:
+        for values in trac.sql('SELECT name, description, due, completed FROM milestone'):
+            yield values
+
+def get_used_labels_and_milestones():
+    """Sets of the label and milestone names used by any ticket.
+    """
+    labels = set()
+    milestones = set()
+    if options.upload:
+        for tid, component, keywords, milestone in bundle.get_index():
+            labels.update(get_labels({'component': component, 'keywords': keywords}))
+            milestones.add(milestone)
+    else:
+        for (component,) in trac.sql('SELECT DISTINCT component FROM ticket'):
+            labels.add(component)
+        if options.keyword_labels:
+            for (keywords,) in trac.sql('SELECT DISTINCT keywords FROM ticket'):
+                labels.update(split_keywords(keywords))
+        for (milestone,) in trac.sql('SELECT DISTINCT milestone FROM ticket'):
+            milestones.add(milestone and milestone.strip())
+    labels.discard(None)
+    labels.discard('')
+    milestones.discard(None)
+    milestones.discard('')
+    return labels, milestones
+
+def reconcile_labels(client, labels, used):
+    """Queue the creation of the used label names missing from labels on
+    the AsyncGitHub client; returns the futures.
+    """
+    # GitHub label names are case insensitive
+    existing = set([name.lower() for name in labels])
+    futures = []
+    for name in sorted(used):
+        if name.lower() in existing:
+            continue
+        existing.add(name.lower())
+        logging.debug("adding label=%s" % name)
+        future = client.labels(data={'name': name})
+        def created(future):
+            if future.error is None:
+                labels[future.value['name']] = future.value['url']
+                metrics.count('labels_created')
+        future.add_done_callback(created)
+        futures.append(future)
+    return futures
+
+def reconcile_milestones(client, milestone_map, used):
+    """Queue the creation of the Trac milestones, and of milestones only
+    found on tickets, missing from milestone_map; returns the futures.
+    """
+    # We have no way to set the milestone closed date in GH.
+    # The 'due' and 'completed' are long ints representing datetimes.
+    milestones = {}
+    for name, description, due, completed in iter_trac_milestones():
+        name = name.strip()
+        logging.debug("milestone name=%s due=%s completed=%s" % (name, due, completed))
+        if completed:
+            state = 'closed'
+        else:
+            state = 'open'
+        milestone = {'title': name,
+                     'state': state,
+                     'description': description,
+                     }
+        if due:
+            milestone['due_on'] = datetime.datetime.fromtimestamp(
+                due / 1000 / 1000).isoformat()
+        milestones[name] = milestone
+    for name in used:
+        # deleted from Trac but still set on tickets
+        milestones.setdefault(name, {'title': name, 'state': 'open'})
+    futures = []
+    for name, milestone in sorted(milestones.items()):
+        if not name or name in milestone_map:
+            continue
+        logging.debug("milestone: %s" % milestone)
+        future = client.milestones(data=milestone)
+        def created(future, name=name):
+            if future.error is None:
+                milestone_map[name] = future.value['number']
+                metrics.count('milestones_created')
+        future.add_done_callback(created)
+        futures.append(future)
+    return futures
+
+def iter_rendered_tickets(comments=False, skip=None, describe=None):
+    """Yield rendered tickets from the bundle when uploading, from Trac otherwise.
+    When syncing, only tickets changed since the last completed run.
+    Tickets for which skip(tid) is true are passed over before they are
+    rendered, and for those where describe(tid) is false the description
+    is not rendered.
+    """
+    if options.upload:
+        for ticket in bundle.iter_tickets(options.ticket_start, options.ticket_end, comments):
+            if skip is None or not skip(ticket['tid']):
+                yield ticket
+    else:
+        for ticket in TracTicket.iter_tickets(options.ticket_start, options.ticket_end, comments, since):
+            if skip is not None and skip(ticket.tid):
+                continue
+            with metrics.timer('render'):
+                rendered = ticket.render(describe is None or describe(ticket.tid))
+            yield rendered
+
+def count_tickets():
+    """Number of tickets in the selected range, for progress reporting.
+    """
+    if options.upload:
+        return len([tid for tid, component, keywords, milestone in bundle.get_index()
+                    if tid >= options.ticket_start and (options.ticket_end == -1 or tid <= options.ticket_end)])
+    where, params = TracTicket.where(options.ticket_start, options.ticket_end, since)
+    return trac.value('SELECT count(*) FROM ticket' + where, params)
+
+def get_marks():
+    """High-water marks of the Trac database before this run, stored in the
+    journal once the run completes and used by the next --sync.
+    """
+    marks = {}
+    for name in ('ticket.changetime', 'ticket_change.time', 'attachment.time'):
+        table, column = name.split('.')
+        marks[name] = trac.value('SELECT max(%s) FROM %s' % (column, table)) or 0
+    return marks
+
+def trac_time_iso(t):
+    # Trac 1.0 and later store microseconds, older versions seconds
+    if t > 1e11:
+        t = t / 1000000
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t))
+
+def get_import_data(ticket, milestone_map):
+    """Issue and comments of a rendered ticket in the form taken by the
+    issue import API, keeping the Trac creation times.
+    """
+    issue = {'title': ticket['title'],
+             'body': ticket['body'] or '',
+             'closed': ticket['status'] == 'closed',
+             }
+    if 'time' in ticket:
+        issue['created_at'] = trac_time_iso(ticket['time'])
+    if ticket['milestone'] and ticket['milestone'] in milestone_map:
+        issue['milestone'] = milestone_map[ticket['milestone']]
+    labels = get_labels(ticket)
+    if labels:
+        issue['labels'] = labels
+    # bundles exported by older versions have the time only in the step
+    comments = [{'body': comment['body'],
+                 'created_at': trac_time_iso(comment.get('time') or int(comment['step'].split(':')[1]))}
+                for comment in ticket['comments']]
+    return issue, comments
+
+def split_keywords(keywords):
+    return [k for k in re.split(r'[\s,]+', keywords or '') if k]
+
+def get_labels(ticket):
+    """Label names of a rendered ticket: its component and, with
+    --keyword-labels, its keywords.
+    """
+    labels = []
+    if ticket['component']:
+        labels.append(ticket['component'])
+    if options.keyword_labels:
+        for keyword in split_keywords(ticket.get('keywords')):
+            if keyword not in labels:
+                labels.append(keyword)
+    return labels
+
+def get_github_data(ticket, milestone_map):
+    """Issue data for a rendered ticket. Its labels and milestone have
+    already been created by reconcile_labels and reconcile_milestones.
+    """
+    issue = {'title': ticket['title']}
+    if ticket['body']:
+        issue['body'] = ticket['body']
+    if ticket['milestone']:
+        m = milestone_map.get(ticket['milestone'])
+        if m:
+            issue['milestone'] = m
+    labels = get_labels(ticket)
+    if labels:
+        issue['labels'] = labels
+
+    # We have to create/map Trac users to GitHub usernames before we can assign
+    # them to tickets; don't see how to do that conveniently now.
+    # if owner.strip():
+    #     ticket['assignee'] = owner.strip()
+    return issue
+
+def run_workers(func, jobs, num_workers):
+    """Call func(*job) for every job using a pool of threads.
+    The jobs iterable is consumed in the calling thread, so it may read from
+    the Trac db. Returns a list of (job, exception) for the jobs that failed.
+    """
+    queue = Queue.Queue(num_workers * 2)
+    errors = []
+    def worker():
+        profile = metrics.start_thread_profile()
+        while True:
+            job = queue.get()
+            if job is None:
+                break
+            try:
+                func(*job)
+            except Exception, e:
+                logging.exception("Failed job %s" % (job[:1],))
+                errors.append((job, e))
+        metrics.stop_thread_profile(profile)
+    threads = []
+    for i in range(num_workers):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for job in jobs:
+        queue.put(job)
+    for t in threads:
+        queue.put(None)
+    for t in threads:
+        t.join()
+    return errors
+
+def content_hash(text):
+    """Digest of a title or text as GitHub keeps it, with normalized line
+    endings and without surrounding whitespace.
+    """
+    text = (text or u'').replace(u'\r\n', u'\n').strip()
+    return hashlib.sha1(text.encode('utf-8')).digest()
+
+comment_header_re = re.compile(r'^(\*\*\[[^\]\n]*\]\*\* )?(\*\[Trac time [^\]\n]*\]\* )?')
+
+def comment_header(text):
+    """The author and time a rendered comment starts with, which identify
+    it even when its text differs.
+    """
+    return comment_header_re.match(text or u'').group(0) or None
+
+issue_url_re = re.compile(r'issues/([0-9]+)$')
+
+def fetch_issue_digests(concurrent):
+    """{number: (title, body, state, label names, milestone number)} for
+    every issue of the repository, with digests in place of the texts.
+    """
+    issues = {}
+    for issue in github.iter_issues(query='state=all&sort=created&direction=asc', concurrent=concurrent):
+        if 'pull_request' in issue:
+            continue
+        issues[issue['number']] = (content_hash(issue['title']), content_hash(issue.get('body')),
+                                   issue['state'],
+                                   set([label['name'].lower() for label in issue.get('labels') or []]),
+                                   (issue.get('milestone') or {}).get('number'))
+    return issues
+
+def fetch_comment_digests(concurrent):
+    """{issue number: [(digest, header)]} for every comment of the
+    repository, read through the repository wide list rather than issue by
+    issue.
+    """
+    comments = {}
+    count = 0
+    for comment in github.iter_repo_comments(query='sort=created&direction=asc', concurrent=concurrent):
+        match = issue_url_re.search(comment.get('issue_url') or '')
+        if match:
+            comments.setdefault(int(match.group(1)), []).append(
+                (content_hash(comment['body']), comment_header(comment['body'])))
+            count += 1
+    metrics.count('comments_read', count)
+    return comments
+
+def ticket_digests(ticket):
+    """What verify_ticket needs of a rendered ticket, small enough to keep
+    for every ticket while GitHub is still being read.
+    """
+    return {'tid': ticket['tid'],
+            'title': content_hash(ticket['title']),
+            'body': content_hash(ticket['body']),
+            'state': ticket['status'] == 'closed' and 'closed' or 'open',
+            'labels': get_labels(ticket),
+            'milestone': ticket['milestone'],
+            'comments': [(content_hash(comment['body']), comment_header(comment['body']), comment['step'])
+                         for comment in ticket['comments']],
+            }
+
+def verify_ticket(ticket, gid, issues, comments, by_content):
+    """Differences between the digests of a ticket and its issue as
+    (kind, detail) pairs.
+    """
+    issue = issues.get(gid)
+    if issue is None:
+        return [('missing_issue', "no issue %d" % gid)]
+    problems = []
+    title, body, state, labels, milestone = issue
+    if title != ticket['title']:
+        problems.append(('mismatched_title', "title differs"))
+    if body != ticket['body']:
+        problems.append(('mismatched_body', "description differs"))
+    if state != ticket['state']:
+        problems.append(('mismatched_state', "issue is %s" % state))
+    missing = [name for name in ticket['labels'] if name.lower() not in labels]
+    if missing:
+        problems.append(('missing_labels', ", ".join(missing)))
+    if ticket['milestone'] and milestone != milestone_id.get(ticket['milestone']):
+        problems.append(('mismatched_milestone', "not in milestone %s" % ticket['milestone']))
+    for number in by_content.get((ticket['title'], ticket['body']), []):
+        if number != gid:
+            problems.append(('duplicated_issue', "also issue %d" % number))
+
+    found = {}
+    for digest, header in comments.get(gid, []):
+        found[digest] = found.get(digest, 0) + 1
+    expected = {}
+    for digest, header, step in ticket['comments']:
+        expected[digest] = expected.get(digest, 0) + 1
+    # Comments on the issue that aren't from Trac, but start like a Trac
+    # comment, are that comment with a different text
+    headers = set([header for digest, header in comments.get(gid, [])
+                   if header and digest not in expected])
+    for digest, header, step in ticket['comments']:
+        if digest not in found:
+            if header in headers:
+                problems.append(('mismatched_comment', step))
+            else:
+                problems.append(('missing_comment', step))
+        elif found[digest] > expected[digest]:
+            problems.append(('duplicated_comment', "%s posted %d times" % (step, found[digest])))
+            found[digest] = expected[digest]
+    return problems
+
+def verify(gids):
+    """Compare every ticket in the range with its issue and comments on
+    GitHub and return the differences and the number of tickets checked.
+    GitHub is only read, in bulk and on background threads while the
+    tickets are rendered.
+    """
+    pool = ThreadPool(2)
+    try:
+        issues_result = pool.apply_async(fetch_issue_digests, (options.workers,))
+        comments_result = pool.apply_async(fetch_comment_digests, (options.workers,))
+        tickets = []
+        progress = Progress('verify', count_tickets(), options.progress_interval)
+        with progress:
+            for ticket in iter_rendered_tickets(comments=True):
+                tickets.append(ticket_digests(ticket))
+                progress.update()
+        issues = issues_result.get()
+        comments = comments_result.get()
+    finally:
+        pool.terminate()
+    logging.info("Read %d issues and %d comments from GitHub" % (
+            len(issues), sum([len(c) for c in comments.values()])))
+    by_content = {}
+    for number, issue in issues.items():
+        by_content.setdefault(issue[:2], []).append(number)
+    problems = []
+    for ticket in tickets:
+        gid = gids.get(ticket['tid'], ticket['tid'])
+        for kind, detail in verify_ticket(ticket, gid, issues, comments, by_content):
+            logging.warning("Ticket %d, issue %d: %s: %s" % (ticket['tid'], gid, kind, detail))
+            problems.append({'ticket': ticket['tid'], 'issue': gid, 'kind': kind, 'detail': detail})
+            metrics.count(kind)
+    return problems, len(tickets)
     
 # Warning: optparse is deprecated in python-2.7 in favor of argparse
 usage = """
   %prog [options] trac_db_path github_username github_password github_repo
+  %prog [options] --export bundle_path trac_db_path
+  %prog [options] --upload bundle_path github_username github_password github_repo
 
   Convert trac tickets to github issues, maintaining issue numbers by inserting
   dummy filler tickets into the github database if necessary.
@@ -220,6 +769,10 @@ usage = """
   Then, use this script with the -r option and any trac references using the
   r1234 syntax will be converted to a git SHA1 commit ID.
 
+  The map is cached in the repository's .git directory until HEAD changes.
+  Adding [-m map_file] together with -r saves the map to map_file; using -m
+  without -r loads it from there, so the git repository isn't needed at all.
+
   Run with:
 
   ./trac-tickets-to-gh.py -r /path/to/repository trac.db github_username "github_password" github_username/projectname
@@ -231,35 +784,175 @@ usage = """
   If you want to continue on after stopping at some point, use:
 
   ./trac-tickets-to-gh.py -r /path/to/repository trac.db github_username "github_password" github_username/projectname -s 11
+
+  Every step acknowledged by GitHub is recorded in a journal file next to the
+  Trac database (trac.db.github_username_projectname.journal by default), so
+  simply re-running the same command after an interruption resumes where it
+  left off. Delete the journal to start over from scratch.
+
+  When Trac stays in use for a while after the migration, --sync brings the
+  issues up to date: only tickets created or changed since the last
+  complete run are read, their new comments and attachments are posted and
+  the state and milestone of their issues are updated. Each complete run
+  records how far it got in the journal.
+
+  Rendering and uploading can also be done separately. --export converts all
+  tickets and comments into a bundle file (one JSON object per line, gzipped
+  if the name ends in .gz) using all CPU cores; the bundle can be checked and
+  then uploaded as many times as needed with --upload, which doesn't need
+  the Trac database or the git repository:
+
+  ./trac-tickets-to-gh.py -r /path/to/repository --export tickets.jsonl.gz trac.db
+  ./trac-tickets-to-gh.py --upload tickets.jsonl.gz github_username "github_password" github_username/projectname
+
+  Ticket attachments are migrated with --attachments path/to/trac/env. Each
+  distinct file is stored once, named by its SHA-1, either in a branch of a
+  git repository (--attachments-git, e.g. the GitHub repository itself; push
+  the branch afterwards) or in a directory (--attachments-dir), and linked
+  from a comment on the issue at the time it was attached. Files are copied
+  in chunks and never loaded into memory as a whole.
+
+  With --backend=import every issue is created together with its comments,
+  labels, milestone, closed state and original Trac dates in a single
+  request through GitHub's issue import API, which needs far fewer requests
+  on tickets with many comments. GitHub processes the imports in the
+  background; the script keeps queuing tickets in order while it polls the
+  status of all pending imports in one request.
+
+  After a migration, --verify reads all issues and comments of the
+  repository in bulk and compares digests of their titles and texts, their
+  state, labels and milestone with the rendered tickets. Missing, duplicated
+  and differing issues and comments are logged and listed in the report;
+  nothing is written to GitHub. With --attachments, give the same
+  attachment options as for the migration.
+
+  With --cache FILE, the GitHub responses read by a run are kept in FILE and
+  a later run asks GitHub with a conditional request whether they changed.
+  Unchanged responses are answered without a body and don't count against
+  the rate limit, so resumed, synced and verifying runs load labels,
+  milestones and issues almost for free. Creating anything drops the cached
+  responses of its kind.
+
+  While running, a progress line with the rate and estimated time left is
+  logged every 30 seconds (see --progress-interval). At the end the time
+  spent in each phase, the request counts, latencies and retries per API
+  endpoint and the rendering time are written as JSON to the --report file
+  (by default next to the journal). --profile also saves cProfile stats for
+  every phase, readable with "python -m pstats DIR/PHASE.prof".
 """
 parser = OptionParser(usage=usage)
 parser.add_option('-q', '--quiet', action="store_true", default=False,
                   help='Decrease logging of activity')
 parser.add_option('-r', '--revision-map', action="store", default="",
                   help='Get svn to git revision map from git dir')
+parser.add_option('-m', '--revision-map-file', action="store", default="",
+                  help='Save the revision map to this file when used with -r, otherwise load it from here')
 parser.add_option('-s', '--ticket-start', action="store", default=1, type=int,
                   help='Starting ticket number (default: 1)')
 parser.add_option('-e', '--ticket-end', action="store", default=-1, type=int,
                   help='Ending ticket number, inclusive (default: all remaining tickets)')
 parser.add_option('-c', '--comments-only', action="store_true", default=False,
                   help='Add comments to tickets; don\'t add any new tickets')
+parser.add_option('--sync', action="store_true", default=False,
+                  help='Only migrate tickets, comments, state and milestone changes made in Trac since the last completed run')
+parser.add_option('--verify', action="store_true", default=False,
+                  help='Only compare the tickets with the issues and comments on GitHub and report the differences')
+parser.add_option('--immutable', action="store_true", default=False,
+                  help='The Trac database is a copy nothing writes to while running, so sqlite can skip locking')
+parser.add_option('-j', '--journal', action="store", default="",
+                  help='Path to the progress journal (default: next to trac_db_path)')
+parser.add_option('--api-url', action="store", default=GitHub.api_url,
+                  help='GitHub API root URL (default: %default)')
+parser.add_option('--export', action="store", default="",
+                  help='Render tickets into this bundle file instead of uploading them')
+parser.add_option('--upload', action="store", default="",
+                  help='Upload tickets from this bundle file instead of the Trac database')
+parser.add_option('-p', '--processes', action="store", default=multiprocessing.cpu_count(), type=int,
+                  help='Number of processes used by --export (default: number of CPUs)')
+parser.add_option('-w', '--workers', action="store", default=8, type=int,
+                  help='Number of parallel workers for ticket updates and comments (default: 8)')
+parser.add_option('--attachments', action="store", default="",
+                  help='Migrate ticket attachments from this Trac environment directory')
+parser.add_option('--attachments-git', action="store", default="",
+                  help='Store attachments in a branch of this git repository')
+parser.add_option('--attachments-branch', action="store", default="trac-attachments",
+                  help='Branch for --attachments-git (default: %default)')
+parser.add_option('--attachments-dir', action="store", default="",
+                  help='Store attachments in this directory instead of git')
+parser.add_option('--attachments-url', action="store", default="",
+                  help='URL the stored attachments are linked with (default: the raw files of '
+                       'the --attachments-branch of github_repo on github.com)')
+parser.add_option('-k', '--keyword-labels', action="store_true", default=False,
+                  help='Also add the Trac keywords of tickets to their issues as labels')
+parser.add_option('-a', '--max-in-flight', action="store", default=0, type=int,
+                  help='Post comments and closes through the non-blocking client with up to this many '
+                       'requests in flight, instead of -w workers handling a ticket each')
+parser.add_option('-b', '--backend', action="store", default="issues", choices=["issues", "import"],
+                  help='Create issues one request at a time through the "issues" API, or with their comments '
+                       'and original dates through the "import" API (default: %default)')
+parser.add_option('--cache', action="store", default="",
+                  help='Keep GitHub responses in this file and only ask GitHub whether they changed on later runs')
+parser.add_option('--cache-size', action="store", default=256, type=int,
+                  help='Megabytes of responses kept in the --cache file (default: %default)')
+parser.add_option('--report', action="store", default="",
+                  help='Write run metrics as JSON to this file (default: next to the journal or bundle)')
+parser.add_option('--progress-interval', action="store", default=30, type=int,
+                  help='Seconds between progress lines, 0 to disable (default: %default)')
+parser.add_option('--profile', action="store", default="",
+                  help='Save cProfile stats of every phase in this directory')
 
-(options, args) = parser.parse_args()
-if options.revision_map:
-    rmap = svn_git_revision_map(options.revision_map)
+if batch is not None:
+    (options, args) = parser.parse_args(batch.argv)
 else:
-    rmap = None
+    (options, args) = parser.parse_args()
+if options.upload:
+    # already rendered, the revision map isn't needed
+    pass
+elif options.revision_map:
+    if batch is not None:
+        rmap = batch.revision_map(options.revision_map)
+    else:
+        rmap = svn_git_revision_map(options.revision_map)
+    if options.revision_map_file:
+        save_revision_map(options.revision_map_file, rmap)
+elif options.revision_map_file:
+    rmap, head = load_revision_map(options.revision_map_file)
+else:
+    rmap = {}
+if not options.upload:
+    wiki = WikiConverter(rmap)
 
-wiki = WikiConverter(rmap)
 #print rmap[1]
 #text = open("test.wiki").read()
 #print wiki.convert(text)
 
 try:
-    [trac_db_path, github_username, github_password, github_repo] = args
+    if options.export:
+        [trac_db_path] = args
+    elif options.upload:
+        [github_username, github_password, github_repo] = args
+    else:
+        [trac_db_path, github_username, github_password, github_repo] = args
 except ValueError:
     parser.error('Wrong number of arguments')
-if not '/' in github_repo:
+if options.export and options.upload:
+    parser.error('Use either --export or --upload')
+if options.sync and (options.upload or options.export):
+    parser.error('--sync reads the changes from the Trac database')
+if options.verify and (options.export or options.sync or options.comments_only):
+    parser.error('--verify can\'t be combined with --export, --sync or --comments-only')
+if options.comments_only and options.backend == 'import':
+    parser.error('--comments-only only works with the issues backend')
+if options.attachments:
+    if options.upload:
+        parser.error('Attachments are linked when rendering, use --attachments with --export')
+    if bool(options.attachments_git) == bool(options.attachments_dir):
+        parser.error('--attachments needs either --attachments-git or --attachments-dir')
+    if not options.attachments_url:
+        if options.export or not options.attachments_git:
+            parser.error('--attachments-url is needed to link the attachments')
+        options.attachments_url = "https://github.com/%s/raw/%s/" % (github_repo, options.attachments_branch)
+if not options.export and not '/' in github_repo:
     parser.error('Repo must be specified like "organization/project"')
 
 if options.quiet:
@@ -267,7 +960,50 @@ if options.quiet:
 else:
     logging.basicConfig(level=logging.DEBUG)
 
-trac = Trac(trac_db_path)
+metrics = Metrics(profile_dir=options.profile or None)
+
+if options.upload:
+    trac = None
+    bundle = TicketBundle(options.upload)
+    source_path = options.upload
+else:
+    trac = Trac(trac_db_path, immutable=options.immutable)
+    source_path = trac_db_path
+
+attachment_links = {}
+since = None
+
+if options.export:
+    attachment_links = load_attachments()
+    logging.info("Rendering Trac tickets into %s using %d processes..." % (options.export, options.processes))
+    start = time.time()
+    with metrics.phase('export'):
+        count = export_bundle(options.export, options.processes)
+    elapsed = time.time() - start
+    logging.info("Exported %d tickets in %.1fs (%.1f tickets/sec)" % (count, elapsed, count / max(elapsed, 0.001)))
+    metrics.count('tickets_rendered', count)
+    metrics.write_report(options.report or options.export + '.report.json',
+                         tickets_per_sec=count / max(elapsed, 0.001))
+    trac.close()
+    sys.exit()
+
+if not options.journal:
+    options.journal = "%s.%s.journal" % (source_path, github_repo.replace('/', '_'))
+if options.verify and not os.path.exists(options.journal):
+    # Issue numbers match the Trac ids unless the journal says otherwise
+    journal = None
+    logging.info("No journal %s, expecting issue numbers to match the ticket ids" % options.journal)
+else:
+    journal = Journal(options.journal)
+    logging.info("Using journal %s with %d tickets already mapped" % (options.journal, len(journal.gids)))
+if trac is not None:
+    run_marks = get_marks()
+if options.sync:
+    since = journal.marks
+    if sorted(since) != sorted(run_marks):
+        logging.error("The journal has no completed run to sync from; run once without --sync first")
+        sys.exit(-1)
+    logging.info("Syncing Trac changes since %s" % ", ".join(["%s=%s" % item for item in sorted(since.items())]))
 logging.info("Checking reporters...")
 
 #for ticket in TracTicket.iter_tickets():
@@ -282,124 +1018,364 @@ logging.info("Checking reporters...")
 #        print text
 #sys.exit()
 
-github = GitHub(github_username, github_password, github_repo)
+cache = pool = limiter = None
+if batch is not None:
+    cache, pool, limiter = batch.cache, batch.pool, batch.limiter
+elif options.cache:
+    cache = ResponseCache(options.cache, options.cache_size << 20)
+github = GitHub(github_username, github_password, github_repo,
+                pool_size=max(options.workers, options.max_in_flight),
+                api_url=options.api_url, metrics=metrics, cache=cache,
+                pool=pool, limiter=limiter)
 
 # Show the Trac usernames assigned to tickets as an FYI
 
-logging.info("Getting Trac ticket owners (will NOT be mapped to GitHub username)...")
-for (username,) in trac.sql('SELECT DISTINCT owner FROM ticket'):
-    if username:
-        username = username.strip() # username returned is tuple like: ('phred',)
-        logging.debug("Trac ticket owner: %s" % username)
-
-
-# Get GitHub labels; we'll merge Trac components into them
-
-logging.info("Getting existing GitHub labels...")
-labels = {}
-for label in github.labels():
-    labels[label['name']] = label['url'] # ignoring 'color'
-    logging.debug("label name=%s" % label['name'])
-
-# Get any existing GitHub milestones so we can merge Trac into them.
-# We need to reference them by numeric ID in tickets.
-# API returns only 'open' issues by default, have to ask for closed like:
-# curl -u 'USER:PASS' https://api.github.com/repos/USERNAME/REPONAME/milestones?state=closed
-
-logging.info("Getting existing GitHub milestones...")
-milestone_id = {}
-for m in github.milestones():
-    milestone_id[m['title']] = m['number']
-    logging.debug("milestone (open)   title=%s" % m['title'])
-for m in github.milestones(query='state=closed'):
-    milestone_id[m['title']] = m['number']
-    logging.debug("milestone (closed) title=%s" % m['title'])
-
-# We have no way to set the milestone closed date in GH.
-# The 'due' and 'completed' are long ints representing datetimes.
-
-logging.info("Migrating Trac milestones to GitHub...")
-milestones = trac.sql('SELECT name, description, due, completed FROM milestone')
-for name, description, due, completed in milestones:
-    name = name.strip()
-    logging.debug("milestone name=%s due=%s completed=%s" % (name, due, completed))
-    if name and name not in milestone_id:
-        if completed:
-            state = 'closed'
-        else:
-            state = 'open'
-        milestone = {'title': name,
-                     'state': state,
-                     'description': description,
-                     }
-        if due:
-            milestone['due_on'] = datetime.datetime.fromtimestamp(
-                due / 1000 / 1000).isoformat()
-        logging.debug("milestone: %s" % milestone)
-        gh_milestone = github.milestones(data=milestone)
-        milestone_id['name'] = gh_milestone['number']
-
-# Copy Trac tickets to GitHub issues, keyed to milestones above
-
-logging.info("Migrating Trac tickets to GitHub...")
-for ticket in TracTicket.iter_tickets():
-    if ticket.tid < options.ticket_start:
-        continue
-    if options.ticket_end > -1 and ticket.tid > options.ticket_end:
-        break
-    logging.info("Ticket %d: [%s] %s" % (ticket.tid, ticket.owner.strip(), ticket.summary))
-    
-    if options.comments_only:
-        gid = ticket.tid
+if trac is not None:
+    logging.info("Getting Trac ticket owners (will NOT be mapped to GitHub username)...")
+    with metrics.phase('owners'):
+        for (username,) in trac.sql('SELECT DISTINCT owner FROM ticket'):
+            if username:
+                username = username.strip() # username returned is tuple like: ('phred',)
+                logging.debug("Trac ticket owner: %s" % username)
+
+
+# Get GitHub labels; we'll merge Trac components (and keywords) into them
+
+with metrics.phase('preload'):
+    logging.info("Getting existing GitHub labels...")
+    labels = {}
+    for label in github.iter_labels():
+        labels[label['name']] = label['url'] # ignoring 'color'
+        logging.debug("label name=%s" % label['name'])
+
+    # Get any existing GitHub milestones so we can merge Trac into them.
+    # We need to reference them by numeric ID in tickets.
+    # API returns only 'open' milestones by default, have to ask for all like:
+    # curl -u 'USER:PASS' https://api.github.com/repos/USERNAME/REPONAME/milestones?state=all
+
+    logging.info("Getting existing GitHub milestones...")
+    milestone_id = {}
+    for m in github.iter_milestones(query='state=all'):
+        milestone_id[m['title']] = m['number']
+        logging.debug("milestone (%s) title=%s" % (m['state'], m['title']))
+
+if options.verify:
+    attachment_links = load_attachments()
+    logging.info("Verifying GitHub issues against Trac tickets...")
+    with metrics.phase('verify'):
+        problems, checked = verify(journal and journal.gids or {})
+    if journal is not None:
+        journal.close()
+    if trac is not None:
+        trac.close()
+    github.close()
+    if cache is not None and batch is None:
+        cache.close()
+    if not options.report:
+        options.report = re.sub(r'\.journal$', '', options.journal) + '.verify.report.json'
+    kinds = {}
+    for problem in problems:
+        kinds[problem['kind']] = kinds.get(problem['kind'], 0) + 1
+    report = metrics.write_report(options.report, tickets=checked, problems=problems,
+                                  rate_limit=github.rate_limit())
+    logging.info("Verified %d tickets with %d requests in %.1fs: %s; report written to %s" % (
+            checked, report['total_requests'], report['seconds'],
+            ", ".join(["%d %s" % (kinds[kind], kind) for kind in sorted(kinds)]) or "no differences",
+            options.report))
+    if problems:
+        sys.exit(1)
+    sys.exit()
+
+# Create every label and milestone the tickets need before the first ticket,
+# all at once, so creating issues never waits for them.
+
+logging.info("Migrating Trac components and milestones to GitHub...")
+with metrics.phase('reconcile'):
+    used_labels, used_milestones = get_used_labels_and_milestones()
+    client = AsyncGitHub(github, options.workers)
+    try:
+        futures = reconcile_milestones(client, milestone_id, used_milestones)
+        futures += reconcile_labels(client, labels, used_labels)
+    finally:
+        client.close()
+    for future in futures:
+        future.result()
+    logging.info("Created %d labels and milestones" % len(futures))
+
+# Copy Trac tickets to GitHub issues, keyed to milestones above.
+# Phase one creates the issues serially, because GitHub numbers must line
+# up with Trac ids. The next free number is read once up front, so gaps in
+# the Trac ids are filled with closed dummy tickets and each real issue is
+# created with its full data in a single request. Phase two posts comments
+# and closes issues in parallel; comments for a single issue are still
+# posted in order by the same worker.
+# With --backend=import each issue is queued together with its comments and
+# closed state through the issue import API instead, and is only mapped in
+# the journal once GitHub reports it imported. Phase two then just finishes
+# tickets left over from runs with the other backend.
+
+def ticket_steps(ticket):
+    """Every journal step of a ticket, all of which an import completes.
+    """
+    steps = ['update'] + [comment['step'] for comment in ticket['comments']]
+    if ticket['status'] == 'closed':
+        steps.append('close')
+    return steps + ['done']
+
+def map_imported(tid, gid, steps):
+    for step in steps:
+        journal.done(tid, step)
+    journal.set_gid(tid, gid)
+    mapped[tid] = gid
+
+import_errors = []
+
+def import_done(key, number):
+    if key[0] == 'dummy':
+        if number != key[1]:
+            import_errors.append("Dummy ticket for %d was imported as %d" % (key[1], number))
+        return
+    tid, steps = key[1:]
+    if number != tid:
+        import_errors.append("Github ticket %d was imported as %d; was another issue added during the migration?" % (tid, number))
+        return
+    map_imported(tid, number, steps)
+    logging.info("Ticket mapping: trac=%d, gh=%d" % (tid, number))
+
+def import_failed(key, errors):
+    import_errors.append("Import of %s %d failed: %s" % (key[0], key[1], errors))
+
+if options.sync:
+    attachment_links = load_attachments()
+else:
+    # Finished tickets don't need their attachments again
+    attachment_links = load_attachments(skip=lambda tid: journal.is_done(tid, 'done'))
+
+logging.info("Creating GitHub issues for Trac tickets...")
+mapped = {}
+importer = None
+with metrics.phase('create'):
+    progress = Progress('create', count_tickets(), options.progress_interval)
+    with progress:
+        if not options.comments_only:
+            next_gid = github.highest_issue_number() + 1
+            logging.info("Next GitHub issue number is %d" % next_gid)
+        if options.backend == 'import':
+            importer = IssueImporter(github, import_done, import_failed,
+                                     max_pending=options.workers * 16)
+        def created(tid):
+            # Tickets created by an earlier run are mapped without rendering
+            gid = journal.get_gid(tid)
+            if gid is None:
+                return False
+            mapped[tid] = gid
+            progress.update()
+            return True
+        for ticket in iter_rendered_tickets(comments=importer is not None, skip=created):
+            progress.update()
+            if import_errors:
+                break
+            tid = ticket['tid']
+            logging.info("Ticket %d: [%s] %s" % (tid, ticket['owner'], ticket['title']))
+
+            if options.comments_only:
+                gid = tid
+            elif tid < next_gid:
+                # Probably created by an interrupted run before it reached the
+                # journal; only take it over if the title matches.
+                gh_issue = github.issues(id_=tid)
+                if gh_issue['title'] != ticket['title']:
+                    logging.error("Github ticket numbering is ahead of track numbering and can't be used.")
+                    sys.exit(-1)
+                gid = tid
+                metrics.count('tickets_adopted')
+                if journal.is_done(tid, 'import'):
+                    # imported with its comments and state
+                    map_imported(tid, gid, ticket_steps(ticket))
+                    continue
+                journal.done(tid, 'update')
+            elif importer is not None:
+                while next_gid < tid:
+                    # the import API closes issues with 'closed', it has no 'state'
+                    dummy = TracTicket.get_dummy_data()
+                    importer.submit(('dummy', next_gid),
+                                    {'title': dummy['title'], 'body': dummy['body'], 'closed': True})
+                    metrics.count('dummies_created')
+                    next_gid += 1
+                issue, comments = get_import_data(ticket, milestone_id)
+                journal.done(tid, 'import')
+                importer.submit(('ticket', tid, ticket_steps(ticket)), issue, comments)
+                next_gid = tid + 1
+                metrics.count('tickets_imported')
+                metrics.count('comments_posted', len(comments))
+                continue
+            else:
+                while next_gid < tid:
+                    TracTicket.add_dummy_ticket()
+                    next_gid += 1
+                issue = get_github_data(ticket, milestone_id)
+                gh_issue = github.issues(data=issue)
+                gid = gh_issue['number']
+                if gid != tid:
+                    logging.error("Github ticket %d was created as %d; was another issue added during the migration?" % (tid, gid))
+                    sys.exit(-1)
+                next_gid = gid + 1
+                journal.done(tid, 'update')
+                metrics.count('tickets_created')
+            logging.info("Ticket mapping: trac=%d, gh=%d" % (tid, gid))
+            journal.set_gid(tid, gid)
+            mapped[tid] = gid
+        if importer is not None:
+            logging.info("Waiting for GitHub to finish the imports...")
+            importer.close()
+if import_errors:
+    for error in import_errors:
+        logging.error(error)
+    sys.exit(-1)
+
+def get_sync_data(ticket):
+    """State and milestone to bring the issue of a ticket migrated by an
+    earlier run up to date.
+    """
+    return {'state': ticket['status'] == 'closed' and 'closed' or 'open',
+            'milestone': milestone_id.get(ticket['milestone'])}
+
+def synced(ticket):
+    # A reopened ticket has to be closed again by a later sync
+    if ticket['status'] == 'closed':
+        journal.done(ticket['tid'], 'close')
     else:
-        # We can't find out the github ticket number in advance, so attempt to add
-        # ticket and see what number results
-        issue = ticket.get_github_summary_data()
-        gh_issue = github.issues(data=issue)
-        gid = gh_issue['number']
-        
-        # If the ticket number isn't what we expect, handle two cases
-        if gid < ticket.tid:
-            # If github is behind Trac, just add a bunch of dummy tickets
-            TracTicket.replace_with_dummy(gid)
-            while gid < ticket.tid - 1:
-                gid = TracTicket.add_dummy_ticket()
-            
-            # Re-add ticket, this time in the correct spot
-            issue = ticket.get_github_data(milestone_id, labels)
-            gh_issue = github.issues(data=issue)
-            gid = gh_issue['number']
-        elif gid > ticket.tid:
-            logging.error("Github ticket numbering is ahead of track numbering and can't be used.")
-            sys.exit(-1)
-        else:
-            # Update the existing ticket with all the remaining info
-            issue = ticket.get_github_data(milestone_id, labels)
-            github.issues(id_=gid, data=issue)
-        logging.info("Ticket mapping: trac=%d, gh=%d" % (ticket.tid, gid))
+        journal.undo(ticket['tid'], 'close')
+
+def update_issue(ticket, gid):
+    tid = ticket['tid']
+    if not options.comments_only and not journal.is_done(tid, 'update'):
+        # Journals from older runs may have issues created with only a title
+        issue = get_github_data(ticket, milestone_id)
+        github.issues(id_=gid, data=issue)
+        journal.done(tid, 'update')
+        metrics.count('tickets_updated')
     
-    # Skip comments while debugging
-    if True:
-        # Add comments
-        comments = trac.sql('SELECT author, time, newvalue FROM ticket_change WHERE field="comment" AND ticket=%s' % ticket.tid)
-        for author, time_t, body in comments:
-            body = body.strip()
-            if body:
-                text = wiki.convert_author(author, "comment by")
-                text += wiki.convert_time(time_t)
-                text += wiki.convert(body)
-                if text:
-                    # prefix comment with author as git doesn't keep them separate
-                    logging.debug('issue comment: %s' % text[:50]) # TODO: escape newlines
-                    github.issue_comments(gid, data={'body': text})
+    # Add comments
+    for comment in ticket['comments']:
+        step = comment['step']
+        if not journal.is_done(tid, step):
+            logging.debug('issue comment: %s' % comment['body'][:50]) # TODO: escape newlines
+            github.issue_comments(gid, data={'body': comment['body']})
+            journal.done(tid, step)
+            metrics.count('comments_posted')
 
     # Close tickets if they need it.
     # The v3 API says we should use PATCH, but
     # http://developer.github.com/v3/ says POST is supported.
-    if ticket.status == 'closed':
+    if options.sync and journal.is_done(tid, 'done'):
+        github.issues(id_=gid, data=get_sync_data(ticket))
+        synced(ticket)
+        metrics.count('issues_synced')
+    elif ticket['status'] == 'closed' and not journal.is_done(tid, 'close'):
         github.issues(id_=gid, data={'state': 'closed'})
+        journal.done(tid, 'close')
+        metrics.count('tickets_closed')
         logging.debug("close")
+    journal.done(tid, 'done')
+    progress.update()
+    logging.info("Ticket %d: updated gh=%d" % (tid, gid))
+
+def update_issues_async(jobs, max_in_flight):
+    """Like run_workers(update_issue, jobs), but queues the steps of every
+    ticket on an AsyncGitHub so up to max_in_flight requests are in flight
+    at once. Steps of one issue still run in order, and a failed step
+    cancels the rest of that issue.
+    """
+    client = AsyncGitHub(github, max_in_flight)
+    errors = []
+    def track(future, job, step, counter, last):
+        def done(future):
+            tid = job[0]['tid']
+            if future.error is None:
+                if step == 'sync':
+                    synced(job[0])
+                else:
+                    journal.done(tid, step)
+                metrics.count(counter)
+                if last:
+                    journal.done(tid, 'done')
+                    progress.update()
+                    logging.info("Ticket %d: updated gh=%d" % (tid, job[1]))
+            elif not future.cancelled():
+                logging.error("Failed ticket %d step %s: %s" % (tid, step, future.error))
+                errors.append((job, future.error))
+        future.add_done_callback(done)
+    try:
+        for job in jobs:
+            ticket, gid = job
+            tid = ticket['tid']
+            steps = []
+            if not options.comments_only and not journal.is_done(tid, 'update'):
+                issue = get_github_data(ticket, milestone_id)
+                steps.append((client.issues(gid, data=issue), 'update', 'tickets_updated'))
+            for comment in ticket['comments']:
+                if not journal.is_done(tid, comment['step']):
+                    future = client.issue_comments(gid, data={'body': comment['body']})
+                    steps.append((future, comment['step'], 'comments_posted'))
+            if options.sync and journal.is_done(tid, 'done'):
+                steps.append((client.issues(gid, data=get_sync_data(ticket)), 'sync', 'issues_synced'))
+            elif ticket['status'] == 'closed' and not journal.is_done(tid, 'close'):
+                steps.append((client.issues(gid, data={'state': 'closed'}), 'close', 'tickets_closed'))
+            if not steps:
+                journal.done(tid, 'done')
+                progress.update()
+            for i, (future, step, counter) in enumerate(steps):
+                track(future, job, step, counter, i == len(steps) - 1)
+    except BaseException:
+        # Let the running requests finish so the journal stays accurate
+        client.close(cancel=True)
+        raise
+    client.close()
+    return errors
 
-trac.close()
+if options.max_in_flight:
+    logging.info("Updating %d GitHub issues with up to %d requests in flight..." % (len(mapped), options.max_in_flight))
+else:
+    logging.info("Updating %d GitHub issues using %d workers..." % (len(mapped), options.workers))
+# Tickets and comments are read here rather than in the workers because the
+# sqlite connection can only be used from the thread that created it.
+# Finished tickets are skipped before they are rendered, and the description
+# is only rendered for issues still to be updated with it.
+jobs = ((ticket, mapped[ticket['tid']])
+        for ticket in iter_rendered_tickets(
+            comments=True,
+            skip=lambda tid: tid not in mapped or (not options.sync and journal.is_done(tid, 'done')),
+            describe=lambda tid: not options.comments_only and not journal.is_done(tid, 'update')))
+with metrics.phase('update'):
+    pending = len([tid for tid in mapped if options.sync or not journal.is_done(tid, 'done')])
+    progress = Progress('update', pending, options.progress_interval)
+    with progress:
+        if options.max_in_flight:
+            errors = update_issues_async(jobs, options.max_in_flight)
+        else:
+            errors = run_workers(update_issue, jobs, options.workers)
+if errors:
+    logging.error("Failed to update Trac tickets: %s" % ", ".join([str(job[0]['tid']) for job, e in errors]))
 
+if trac is not None:
+    trac.close()
+if trac is not None and not errors and not options.comments_only and \
+        options.ticket_start == 1 and options.ticket_end == -1:
+    # Everything up to these marks is on GitHub now
+    journal.set_marks(run_marks)
+journal.close()
+github.close()
+if cache is not None and batch is None:
+    cache.close()
 
+if not options.report:
+    options.report = re.sub(r'\.journal$', '', options.journal) + '.report.json'
+report = metrics.write_report(options.report,
+                              tickets_per_sec=len(mapped) / max(time.time() - metrics.started, 0.001),
+                              errors=len(errors), rate_limit=github.rate_limit())
+logging.info("%d tickets, %d requests, %d retries in %.1fs; report written to %s" % (
+        len(mapped), report['total_requests'], sum(report['retries'].values()),
+        report['seconds'], options.report))
+if errors:
+    sys.exit(1)
@@ -7,48 +7,109 @@
 
 import os, sys, re, time
 import datetime
-# TODO: conditionalize and use 'json'
+import threading
+import multiprocessing
+import hashlib
+try:
+    import json
+except ImportError:
+    import simplejson as json
 import logging
 from optparse import OptionParser
-import sqlite3
-
-class Trac(object):
-    # We don't have a way to close (potentially nested) cursors
-
-    def __init__(self, trac_db_path):
-        self.trac_db_path = trac_db_path
-        try:
-            self.conn = sqlite3.connect(self.trac_db_path)
-        except sqlite3.OperationalError, e:
-            raise RuntimeError("Could not open trac db=%s e=%s" % (
-                    self.trac_db_path, e))
-
-    def sql(self, sql_query):
-        """Create a new connection, send the SQL query, return response.
-        We need unique cursors so queries in context of others work.
-        """
-        cursor = self.conn.cursor()
-        cursor.execute(sql_query)
-        return cursor
 
-    def close(self):
-        self.conn.close()
+from fastimport import FastImport
+from tracdb import Trac
+
+class WikiManifest(object):
+    """Remembers, for every page written to the wiki clone, the Trac version
+    it came from, the hash of the output and the CamelCase words in it that
+    could become links. Only pages whose source changed, or which mention a
+    page that was added or removed since, need to be converted again.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.pages = {}
+        if os.path.exists(path):
+            fh = open(path)
+            self.pages = json.load(fh)['pages']
+            fh.close()
+
+    def names(self):
+        return frozenset(self.pages)
+
+    def needs_update(self, name, version, time_t, changed_names):
+        entry = self.pages.get(name)
+        if entry is None or entry['version'] != version or entry['time'] != time_t:
+            return True
+        for word in entry['words']:
+            if word in changed_names:
+                return True
+        return False
+
+    def get_hash(self, name):
+        entry = self.pages.get(name)
+        if entry:
+            return entry['hash']
+
+    def update(self, name, version, time_t, filename, hash, words):
+        self.pages[name] = {'version': version,
+                            'time': time_t,
+                            'filename': filename,
+                            'hash': hash,
+                            'words': sorted(words),
+                            }
+
+    def remove(self, name):
+        return self.pages.pop(name)
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        fh = open(tmp, "w")
+        json.dump({'version': 1, 'pages': self.pages}, fh, sort_keys=True)
+        fh.close()
+        os.rename(tmp, self.path)
 
 class TracWiki(object):
-    wiki_names = {}
-    
+    # Names of all pages, filled by load_names() before any conversion
+    wiki_names = frozenset()
+
+    regexp = tuple([(re.compile(pattern), replacement) for pattern, replacement in (
+        ('^\s\s\s\*', '**'),
+        ('^\s\s\*', '**'),
+        ('^\s\*', '*'),
+        ('^\s[0-9]\.', '#'),
+        ('\{{3}', '<tt>'),                # open code/verbatim line segment
+        ('\}{3}', '</tt>'),               # close code/verbatim line segment
+        ('^(.+)::\s*$', ';\\1'),              # definition list
+        ('\* (http.*)', '* [\\1]'),                  # web link
+        ('\[wiki:(.+?)\]', '[[\\1]]'),
+    )])
+    # CamelCase, dont change if CamelCase is in InternalLink
+    wiki_words = re.compile(r'(!?[A-Z]+[a-z]+[A-Z][A-Za-z]*)')
+#    ('(\b[A-Z]+[a-z]+[A-Z][A-Za-z]*\b)','[[\\1]]'),  # CamelCase, dont change if CamelCase is in InternalLink
+    code_start = re.compile(r'\s*\{{3}\s*$')
+    code_end = re.compile(r'\s*\}{3}\s*$')
+
+    @classmethod
+    def iter_latest_versions(cls):
+        """Yield (name, version, time) of the newest version of every page.
+        """
+        return trac.sql('SELECT name, max(version), time FROM wiki GROUP BY name')
+
     @classmethod
-    def iter_wiki(cls):
-        entries = trac.sql('SELECT name, text, max(version) FROM wiki GROUP BY name')
-        for values in entries:
-            wiki = TracWiki(*values)
-            cls.wiki_names[wiki.name] = wiki
-        for wiki in cls.wiki_names.values():
-            yield wiki
+    def iter_wiki(cls, pages):
+        """Yield the given (name, version, time) pages with their text.
+        """
+        for name, version, time_t in pages:
+            for (text,) in trac.sql('SELECT text FROM wiki WHERE name = ? AND version = ?', (name, version)):
+                yield TracWiki(name, text, version, time_t)
     
     def __init__(self, *values):
         self.name = values[0]
         self.text = values[1]
+        self.version = values[2]
+        self.time = values[3]
+        self.link_words = set()
     
     def get_filename(self):
         if self.name == "WikiStart":
@@ -57,44 +118,31 @@ class TracWiki(object):
         
     def get_mediawiki(self):
         text = self.text
+        wiki_names = self.wiki_names
         
-        regexp = (
-            ('^\s\s\s\*', '**'),
-            ('^\s\s\*', '**'),
-            ('^\s\*', '*'),
-            ('^\s[0-9]\.', '#'),
-            ('\{{3}', '<tt>'),                # open code/verbatim line segment
-            ('\}{3}', '</tt>'),               # close code/verbatim line segment
-            ('^(.+)::\s*$', ';\\1'),              # definition list
-            ('\* (http.*)', '* [\\1]'),                  # web link
-            ('\[wiki:(.+?)\]', '[[\\1]]'),
-        )
-        wiki_words = (
-            (r'(!?[A-Z]+[a-z]+[A-Z][A-Za-z]*)', ),  # CamelCase, dont change if CamelCase is in InternalLink
-#            ('(\b[A-Z]+[a-z]+[A-Z][A-Za-z]*\b)','[[\\1]]'),  # CamelCase, dont change if CamelCase is in InternalLink
-        )
         lines = []
         in_code_block = False
         for line in text.splitlines():
-            if re.match(r'\s*\{{3}\s*$', line):
+            if self.code_start.match(line):
                 line = "<pre>"
                 in_code_block = True
-            elif re.match(r'\s*\}{3}\s*$', line):
+            elif self.code_end.match(line):
                 line = "</pre>"
                 in_code_block = False
             elif not in_code_block:
-                for item in regexp:
-                    line = re.sub(item[0], item[1], line)
-                for splitter in wiki_words:
-                    words = re.split(splitter[0], line)
-                    processed = []
-                    for word in words:
-                        if word in self.wiki_names:
-                            word = "[[%s]]" % word
-                        elif word.startswith("!"):
-                            word = "<nowiki>%s</nowiki>" %word[1:]
-                        processed.append(word)
-                    line = "".join(processed)
+                for regexp, replacement in self.regexp:
+                    line = regexp.sub(replacement, line)
+                processed = []
+                words = self.wiki_words.split(line)
+                # odd pieces are the CamelCase matches
+                self.link_words.update(words[1::2])
+                for word in words:
+                    if word in wiki_names:
+                        word = "[[%s]]" % word
+                    elif word.startswith("!"):
+                        word = "<nowiki>%s</nowiki>" %word[1:]
+                    processed.append(word)
+                line = "".join(processed)
             lines.append(line)
         lines = self.scan_definition_list(lines)
         wiki_text = "\n".join(lines) + "\n"
@@ -117,6 +165,63 @@ class TracWiki(object):
             newlines.append(line)
         return newlines
 
+def convert_page(values):
+    """Process pool worker: returns the page as (values, filename, text,
+    link words, error). Errors are returned rather than raised so the writer
+    always hears back.
+    """
+    wiki = TracWiki(*values)
+    try:
+        filename, wiki_text = wiki.get_mediawiki()
+    except Exception, e:
+        return values, None, None, None, "%s: %s" % (e.__class__.__name__, e)
+    return values, filename, wiki_text, wiki.link_words, None
+
+def iter_history():
+    """Yield (name, text, version, time, author, comment) for every version
+    of every page in the order they were saved.
+    """
+    return trac.sql('SELECT name, text, version, time, author, comment FROM wiki ORDER BY time, name, version')
+
+def convert_version(values):
+    """Process pool worker for --history, returns (filename, data).
+    """
+    wiki = TracWiki(*values[:4])
+    filename, wiki_text = wiki.get_mediawiki()
+    return filename, wiki_text.encode("utf-8")
+
+def import_history(git_path, branch, processes):
+    """Commit every version of every page into the branch of the git wiki
+    repository, with the Trac author and time of the change. Versions are
+    converted in batches on a process pool while the next batch is read.
+    """
+    importer = FastImport(git_path, branch)
+    pool = multiprocessing.Pool(processes)
+    batch_size = processes * 64
+    rows = iter_history()
+    pending = None
+    try:
+        while True:
+            batch = [values for i, values in zip(xrange(batch_size), rows)]
+            if pending is not None:
+                batch_values, results = pending
+                for values, (filename, data) in zip(batch_values, results.get()):
+                    name, text, version, time_t, author, comment = values
+                    if time_t > 100000000000:
+                        # Trac 0.12 and later store microseconds
+                        time_t = time_t // 1000000
+                    message = "%s (Trac version %d)" % (name, version)
+                    if comment:
+                        message += "\n\n%s" % comment
+                    importer.commit(author or "anonymous", time_t, message, [(filename, data)])
+            if not batch:
+                break
+            pending = (batch, pool.map_async(convert_version, batch, chunksize=16))
+    finally:
+        pool.terminate()
+    importer.close()
+    return importer.count
+
     
 # Warning: optparse is deprecated in python-2.7 in favor of argparse
 usage = """
@@ -129,12 +234,34 @@ usage = """
   url to which you can determine from the "Git Access" tab of your wiki home.
 
   For example, if you have a project 
+
+  A manifest of the converted pages is kept in the clone's .git directory,
+  so later runs only rewrite the pages that changed in Trac (or that mention
+  a page that was added or removed) and delete the files of removed pages.
+  Use --full to convert everything again.
+
+  With --history, every saved version of every page is converted instead
+  and committed to the wiki repository with git fast-import, keeping the
+  Trac author and time of each change. The working tree isn't touched, so
+  run "git checkout -f" in the clone afterwards to see the result.
 """
 parser = OptionParser(usage=usage)
 parser.add_option('-q', '--quiet', action="store_true", default=False,
                   help='Decrease logging of activity')
 parser.add_option('-r', '--revision-map', action="store", default="",
                   help='Get svn to git revision map from git dir')
+parser.add_option('--immutable', action="store_true", default=False,
+                  help='The Trac database is a copy nothing writes to while running, so sqlite can skip locking')
+parser.add_option('-m', '--manifest', action="store", default="",
+                  help='Path of the manifest (default: .git/trac-wiki-manifest.json in git_wiki_path)')
+parser.add_option('--full', action="store_true", default=False,
+                  help='Convert all pages, ignoring the manifest')
+parser.add_option('--history', action="store_true", default=False,
+                  help='Import the full page history as git commits')
+parser.add_option('-b', '--branch', action="store", default="master",
+                  help='Branch receiving the --history commits (default: %default)')
+parser.add_option('-p', '--processes', action="store", default=multiprocessing.cpu_count(), type=int,
+                  help='Number of processes converting pages (default: number of CPUs)')
 
 (options, args) = parser.parse_args()
 
@@ -148,16 +275,76 @@ if options.quiet:
 else:
     logging.basicConfig(level=logging.DEBUG)
 
-trac = Trac(trac_db_path)
+trac = Trac(trac_db_path, immutable=options.immutable)
+
+if options.history:
+    logging.info("Importing Trac wiki history into %s branch %s..." % (git_wiki_path, options.branch))
+    TracWiki.wiki_names = frozenset([name for name, version, time_t in TracWiki.iter_latest_versions()])
+    count = import_history(git_wiki_path, options.branch, options.processes)
+    logging.info("Imported %d page versions" % count)
+    trac.close()
+    sys.exit()
+
+if not options.manifest:
+    git_dir = os.path.join(git_wiki_path, '.git')
+    if not os.path.isdir(git_dir):
+        git_dir = git_wiki_path
+    options.manifest = os.path.join(git_dir, 'trac-wiki-manifest.json')
+manifest = WikiManifest(options.manifest)
+if options.full:
+    manifest.pages = {}
 
 logging.info("Migrating Trac wiki entries to mediawiki...")
-for wiki in TracWiki.iter_wiki():
-    print wiki.name
-    filename, wiki_text = wiki.get_mediawiki()
-    fh = open(os.path.join(git_wiki_path, filename), "w")
-    fh.write(wiki_text.encode("utf-8"))
-    fh.close()
+pages = list(TracWiki.iter_latest_versions())
+TracWiki.wiki_names = frozenset([name for name, version, time_t in pages])
+changed_names = TracWiki.wiki_names.symmetric_difference(manifest.names())
+todo = [page for page in pages if manifest.needs_update(page[0], page[1], page[2], changed_names)]
+logging.info("%d of %d pages need converting" % (len(todo), len(pages)))
+
+current_filenames = set(["%s.wiki" % TracWiki(name, None, version, time_t).get_filename()
+                         for name, version, time_t in pages])
+for name in manifest.names() - TracWiki.wiki_names:
+    filename = manifest.remove(name)['filename']
+    path = os.path.join(git_wiki_path, filename)
+    if filename not in current_filenames and os.path.exists(path):
+        logging.info("Removing %s, page %s no longer exists" % (filename, name))
+        os.remove(path)
+
+# The page name index is built before the pool starts so the forked workers
+# share it. Pages are read here, because of sqlite, and each result is
+# written by the pool's result thread as soon as it's converted.
+pool = multiprocessing.Pool(options.processes)
+in_flight = threading.BoundedSemaphore(options.processes * 4)
+errors = []
+
+def write_page(result):
+    try:
+        (name, text, version, time_t), filename, wiki_text, words, error = result
+        print name
+        if error:
+            logging.error("Failed converting %s: %s" % (name, error))
+            errors.append(name)
+            return
+        data = wiki_text.encode("utf-8")
+        hash = hashlib.sha1(data).hexdigest()
+        path = os.path.join(git_wiki_path, filename)
+        if hash != manifest.get_hash(name) or not os.path.exists(path):
+            fh = open(path, "w")
+            fh.write(data)
+            fh.close()
+        manifest.update(name, version, time_t, filename, hash, words)
+    finally:
+        in_flight.release()
+
+for wiki in TracWiki.iter_wiki(todo):
+    in_flight.acquire()
+    pool.apply_async(convert_page, ((wiki.name, wiki.text, wiki.version, wiki.time),), callback=write_page)
+pool.close()
+pool.join()
+manifest.save()
 
 trac.close()
+if errors:
+    sys.exit(1)
 
 
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# Read-only access to a Trac sqlite database, shared by the migration
+# scripts and tuned for large databases on slow storage.
+
+import os
+import urllib
+import sqlite3
+import logging
+
+def supports_uri():
+    """Whether this sqlite library takes file: URIs as database names.
+    Python 2 has no uri=True, so it only works if sqlite was built with
+    SQLITE_USE_URI.
+    """
+    conn = sqlite3.connect(':memory:')
+    try:
+        options = [option for (option,) in conn.execute('PRAGMA compile_options')]
+    finally:
+        conn.close()
+    return 'USE_URI' in options or 'USE_URI=1' in options
+
+class Trac(object):
+    """Read-only connection to a Trac database.
+
+    The database is opened through a mode=ro URI where sqlite supports it,
+    and with PRAGMA query_only otherwise. With immutable, sqlite skips all
+    locking and change detection, which is much faster on network storage
+    but only safe on a copy that nothing writes to while it's open. It
+    needs the URI too, and is left out with a warning without it.
+    Memory mapped I/O and a large page cache keep repeated reads off disk.
+    """
+    # sqlite caps mmap_size at its compile time maximum
+    mmap_size = 1 << 30
+    cache_kb = 256 * 1024
+    batch_size = 512
+
+    def __init__(self, trac_db_path, immutable=False):
+        self.trac_db_path = trac_db_path
+        if not os.path.isfile(trac_db_path):
+            raise RuntimeError("Could not open trac db=%s e=no such file" % trac_db_path)
+        try:
+            if supports_uri():
+                uri = "file:%s?mode=ro" % urllib.quote(os.path.abspath(trac_db_path))
+                if immutable:
+                    uri += "&immutable=1"
+                self.conn = sqlite3.connect(uri, cached_statements=256)
+            else:
+                if immutable:
+                    logging.warning("This sqlite can't open file: URIs, so trac db=%s is opened "
+                                    "read-only without immutable" % trac_db_path)
+                self.conn = sqlite3.connect(trac_db_path, cached_statements=256)
+                self.conn.execute('PRAGMA query_only = ON')
+            self.conn.execute('PRAGMA mmap_size = %d' % self.mmap_size)
+            self.conn.execute('PRAGMA cache_size = -%d' % self.cache_kb)
+            # ORDER BY on unindexed columns sorts in memory
+            self.conn.execute('PRAGMA temp_store = MEMORY')
+        except sqlite3.OperationalError, e:
+            raise RuntimeError("Could not open trac db=%s e=%s" % (
+                    self.trac_db_path, e))
+
+    def sql(self, sql_query, params=()):
+        """Run the query on a new cursor and return an iterator over the rows,
+        fetched batch_size at a time. Each query has its own cursor so queries
+        can be read in step with each other. Values must be passed in params
+        rather than formatted into the query, which also lets sqlite reuse
+        the compiled statement.
+        """
+        cursor = self.conn.cursor()
+        cursor.arraysize = self.batch_size
+        cursor.execute(sql_query, params)
+        return self.iter_rows(cursor)
+
+    def iter_rows(self, cursor):
+        while True:
+            rows = cursor.fetchmany()
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+    def value(self, sql_query, params=()):
+        """First column of the first row of the query, or None.
+        """
+        row = self.conn.execute(sql_query, params).fetchone()
+        return row and row[0]
+
+    def close(self):
+        self.conn.close()
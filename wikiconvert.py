@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Convert Trac wiki markup in ticket descriptions and comments to GitHub
+# flavored markdown.
+
+import re
+import time
+
+# Inline constructs, shared by the full text pattern and the pattern used to
+# convert the text inside links and emphasis. Regexps to convert to markdown
+# borrowed and modified from
+# http://zim-wiki.org/wiki/doku.php?id=script_to_convert_moinmoin_pages_to_zim
+inline_rules = r"""
+    (?P<link>\[(?P<url>http[^ \n]*)\ (?P<text>[^\]\n]*)\])      # web link
+  | '{5}(?P<bolditalic>[^'\n]*)'{5}                           # bold and italic
+  | '{3}(?P<bold>[^'\n]*)'{3}                                 # bold
+  | '{2}(?P<italic>[^'\n]*)'{2}                               # italic
+  | (?P<code>\{{3}|\}{3})                                     # code/verbatim line segment
+  | \(In\ \[(?P<commit>[0-9]+)\]\)                            # svn post-commit hook
+  | \br(?P<rev>[0-9]+)\b                                      # revision reference
+"""
+
+# Constructs that only apply at the start of a line. Whitespace is matched
+# with [^\S\n] so it never crosses into the previous line.
+line_rules = r"""
+    ^[^\S\n]*(?P<fence>\{{3}|\}{3})[^\S\n]*$                  # code block
+  | ^(?P<indent>[^\S\n]{1,4})(?P<marker>\*|[0-9]\.)           # list item
+"""
+
+class WikiConverter(object):
+    """Converts Trac wiki text to markdown in a single pass.
+
+    Every construct is one alternative of a precompiled pattern, so the
+    text is scanned once and each match is rewritten by a handler; text
+    inside links and emphasis is converted recursively with the inline
+    alternatives. svn revision references are replaced by the git commit
+    from the revision map.
+    """
+    tokens = re.compile(line_rules + "|" + inline_rules, re.MULTILINE | re.VERBOSE)
+    inline = re.compile(inline_rules, re.VERBOSE)
+
+    # Numbered lists are renumbered by indent; three spaces is left alone
+    numbered_indent = {1: '1.', 2: '  1.', 4: '    1.'}
+
+    def __init__(self, rev_map):
+        self.svn_to_git = rev_map
+        self.handlers = {
+            'fence': lambda m: '```',
+            'marker': self.convert_list_item,
+            'link': lambda m: '[%s](%s)' % (self.convert_inline(m.group('text')), m.group('url')),
+            'bolditalic': lambda m: '**//%s//**' % self.convert_inline(m.group('bolditalic')),
+            'bold': lambda m: '**%s**' % self.convert_inline(m.group('bold')),
+            'italic': lambda m: '//%s//' % self.convert_inline(m.group('italic')),
+            'code': lambda m: '`',
+            'commit': lambda m: self.convert_rev(m.group('commit')),
+            'rev': lambda m: self.convert_rev(m.group('rev')),
+        }
+
+    def replace(self, match):
+        # lastgroup is the outermost named group of the alternative that
+        # matched; the list item alternative ends with 'marker'
+        return self.handlers[match.lastgroup](match)
+
+    def convert_list_item(self, match):
+        if match.group('marker') == '*':
+            return '*'
+        return self.numbered_indent.get(len(match.group('indent')), match.group(0))
+
+    def convert_rev(self, rev):
+        rev = int(rev)
+        return self.svn_to_git.get(rev, "[old svn rev%d]" % rev)
+
+    def convert_inline(self, text):
+        return self.inline.sub(self.replace, text)
+
+    def convert_line(self, line):
+        return self.tokens.sub(self.replace, line)
+
+    def convert(self, text):
+        # Normalize line endings so the whole text is converted by one sub
+        return self.tokens.sub(self.replace, "\n".join(text.splitlines()))
+
+    # Email addresses are truncated to prevent spam to them
+    email_domain = re.compile(r"@[^\s,;<>]+")
+
+    def hide_emails(self, r):
+        """Truncate every email address in r after the @, so a list like
+        'joe@example.com, Ann <ann@example.org>' becomes
+        'joe@..., Ann <ann@...>'.
+        """
+        return self.email_domain.sub("@...", r)
+
+    def convert_author(self, r, intro="reported by"):
+        # FIXME: modify this list to treat any of the entries as yourself;
+        # otherwise the author will be annotated in the ticket.
+        if r and r not in ["anonymous"]:
+            r = self.hide_emails(r)
+            text = "**[%s %s]** " % (intro, r)
+        else:
+            text = ""
+        return text
+
+    def convert_time(self, t):
+        try:
+            return "*[Trac time %s]* " % time.strftime("%Y%m%d %H%M%SZ", time.gmtime(int(t)))
+        except:
+            return ""
+
+    # Fields whose values are long texts; only the fact they changed is shown
+    text_fields = frozenset(['description'])
+    # Fields whose values are people, shown with their emails hidden
+    person_fields = frozenset(['cc', 'owner', 'reporter'])
+
+    def convert_changes(self, changes):
+        """Markdown list of (field, oldvalue, newvalue) ticket changes, worded
+        like the Trac ticket timeline.
+        """
+        lines = []
+        for field, old, new in changes:
+            old = (old or '').strip()
+            new = (new or '').strip()
+            if field in self.person_fields:
+                old, new = self.hide_emails(old), self.hide_emails(new)
+            if field in self.text_fields:
+                lines.append("* **%s** modified" % field)
+            elif not old:
+                lines.append("* **%s** set to *%s*" % (field, new))
+            elif not new:
+                lines.append("* **%s** *%s* deleted" % (field, old))
+            else:
+                lines.append("* **%s** changed from *%s* to *%s*" % (field, old, new))
+        return "\n".join(lines)